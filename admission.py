@@ -0,0 +1,124 @@
+import os
+import math
+import time
+from collections import deque
+
+from starlette.responses import JSONResponse
+
+# === CONFIGURATION ===
+# Grading requests admitted at once (running + waiting for the grading pool); the rest get 429
+MAX_QUEUE_DEPTH = int(os.environ.get("MCQ_MAX_QUEUE_DEPTH", "32"))
+# Grading requests one client may have admitted at once
+MAX_PER_CLIENT = int(os.environ.get("MCQ_MAX_PER_CLIENT", "4"))
+# Completions over this window give the service rate behind Retry-After
+RATE_WINDOW_S = 60.0
+DEFAULT_RETRY_AFTER_S = 5      # before any request has completed
+MAX_RETRY_AFTER_S = 120
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def client_id(scope):
+    # The app may send X-Client-ID (many phones share one school NAT address)
+    for name, value in scope.get("headers", []):
+        if name == b"x-client-id" and value:
+            return "id:" + value.decode("latin-1")[:64]
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+# === ADMISSION CONTROLLER ===
+# Only touched from the event loop, so no locking
+class AdmissionController:
+    def __init__(self, max_depth=MAX_QUEUE_DEPTH, max_per_client=MAX_PER_CLIENT, window_s=RATE_WINDOW_S):
+        self.max_depth = max(1, max_depth)
+        self.max_per_client = max(1, max_per_client)
+        self.window_s = window_s
+        self.in_flight = 0
+        self.rejected = {"queue_full": 0, "client_limit": 0}
+        self._per_client = {}
+        self._completions = deque()
+        self._started = time.monotonic()
+
+    def acquire(self, client):
+        mine = self._per_client.get(client, 0)
+        if self.in_flight >= self.max_depth:
+            self.rejected["queue_full"] += 1
+            # Requests ahead of this one that must finish before a slot frees up
+            ahead = self.in_flight - self.max_depth + 1
+            raise AdmissionRejected("Server is busy, retry later.", self._retry_after(ahead))
+        if mine >= self.max_per_client:
+            self.rejected["client_limit"] += 1
+            # This client's requests finish at its share of the overall rate
+            share = mine / max(self.in_flight, 1)
+            raise AdmissionRejected(
+                f"Too many requests in flight for this client (limit {self.max_per_client}).",
+                self._retry_after(1, share))
+        self.in_flight += 1
+        self._per_client[client] = mine + 1
+
+    def release(self, client):
+        self.in_flight -= 1
+        left = self._per_client.get(client, 1) - 1
+        if left > 0:
+            self._per_client[client] = left
+        else:
+            self._per_client.pop(client, None)
+        self._completions.append(time.monotonic())
+
+    def service_rate(self):
+        # Completed requests per second over the last window
+        now = time.monotonic()
+        while self._completions and self._completions[0] < now - self.window_s:
+            self._completions.popleft()
+        elapsed = min(self.window_s, now - self._started)
+        return len(self._completions) / elapsed if elapsed > 0 else 0.0
+
+    def _retry_after(self, ahead, share=1.0):
+        rate = self.service_rate() * share
+        if rate <= 0:
+            return DEFAULT_RETRY_AFTER_S
+        return int(min(MAX_RETRY_AFTER_S, max(1, math.ceil(ahead / rate))))
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_queue_depth": self.max_depth,
+            "max_per_client": self.max_per_client,
+            "clients": len(self._per_client),
+            "service_rate": self.service_rate(),
+            "rejected": dict(self.rejected),
+        }
+
+
+# === ASGI MIDDLEWARE ===
+# Sits in front of the grading endpoints, so a rejected upload is answered before its body is read
+class AdmissionMiddleware:
+    def __init__(self, app, controller, paths):
+        self.app = app
+        self.controller = controller
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        client = client_id(scope)
+        try:
+            self.controller.acquire(client)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                status_code=429,
+                content={"error": e.reason, "retry_after": e.retry_after, "answers": []},
+                headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(client)
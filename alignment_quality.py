@@ -0,0 +1,122 @@
+import os
+
+import cv2
+import numpy as np
+
+from fiducials import CORNERS, template_points
+
+# === CONFIGURATION ===
+# Sheets failing these checks are rejected (HTTP 422, naming the corner) before any model runs;
+# MCQ_ALIGN_CHECK=0 restores grading whatever the alignment produced
+ALIGN_CHECK = os.environ.get("MCQ_ALIGN_CHECK", "1") == "1"
+SQUARE_MARKER_SIDE = 90             # printed corner square side in aligned-template px
+MAX_REPROJECTION_PX = 15.0          # template px between a marker's mapped and printed corners
+MIN_SIZE_RATIO, MAX_SIZE_RATIO = 0.75, 1.33     # found / printed marker side
+MAX_ANGLE_DEVIATION = 12.0          # degrees from square, at each corner of the markers' quadrilateral
+MAX_ASPECT_DEVIATION = 0.25         # relative; photographed frame width/height vs the template's
+
+
+class AlignmentRejected(ValueError):
+    # The report stays in args, so the exception survives pickling from grading workers
+    def __init__(self, report):
+        super().__init__(report)
+        self.report = report
+
+    def __str__(self):
+        return self.report["message"]
+
+
+# === GEOMETRY ===
+def _corner_angle(prev, point, nxt):
+    v1, v2 = prev - point, nxt - point
+    cos = np.dot(v1, v2) / max(np.linalg.norm(v1) * np.linalg.norm(v2), 1e-9)
+    return float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))))
+
+def _marker_fit(quad, M, corner, template_size, marker_side, outset):
+    # (reprojection px, size ratio) of one marker in the aligned frame. Each printed corner is
+    # matched to the nearest mapped one, so the order of the found quad doesn't matter.
+    mapped = cv2.perspectiveTransform(np.asarray(quad, dtype=np.float64)[None], M)[0]
+    printed = template_points(corner, *template_size, side=marker_side, outset=outset)
+    reprojection = max(np.linalg.norm(mapped - p, axis=1).min() for p in printed)
+    size = np.sqrt(abs(cv2.contourArea(mapped.astype(np.float32)))) / marker_side
+    return float(reprojection), float(size)
+
+
+# === REPORT ===
+def assess(markers, M, image_shape, template_size, marker_side, fiducials, missing=(), outset=0):
+    # markers: photo-space 4x2 quads for (TL, TR, BL, BR), None where a marker wasn't found;
+    # outset: how far outside the frame corners the marker centres are printed.
+    # Returns a JSON-ready report; "failed_corner" names the first corner that fails a check.
+    corners = {name: {"found": quad is not None} for name, quad in zip(CORNERS, markers)}
+    failures = []
+
+    def fail(corner, reason, detail):
+        failures.append((corner, reason, detail))
+
+    if len(set(missing)) == len(CORNERS):
+        # Nothing to point at: no sheet in view, or markers too small/blurred to see
+        fail(None, "no_markers", "no corner markers found")
+    else:
+        for corner in missing:
+            fail(corner, "missing", "no marker found")
+    if M is None:
+        if missing:
+            # Quadrants with a marker-like blob count as found, even though alignment failed
+            for i, name in enumerate(CORNERS):
+                corners[name]["found"] = i not in missing
+        if not failures:
+            fail(None, "not_found", "sheet markers not found")
+        return _report(corners, failures, fiducials)
+    if not np.isfinite(M).all() or abs(np.linalg.det(M)) < 1e-12:
+        fail(None, "degenerate", "markers do not form a sheet outline")
+        return _report(corners, failures, fiducials)
+
+    h, w = image_shape[:2]
+    centres = [None if quad is None else np.asarray(quad, dtype=np.float64).mean(axis=0) for quad in markers]
+    for i, (name, quad, centre) in enumerate(zip(CORNERS, markers, centres)):
+        if quad is None:
+            continue
+        if (centre[0] >= w / 2) != bool(i % 2) or (centre[1] >= h / 2) != (i >= 2):
+            fail(i, "outside_corner", "marker found outside its corner of the photo")
+        reprojection, size = _marker_fit(quad, M, i, template_size, marker_side, outset)
+        corners[name].update(reprojection_px=round(reprojection, 2), size_ratio=round(size, 3))
+        if reprojection > MAX_REPROJECTION_PX:
+            fail(i, "reprojection", f"marker corners {reprojection:.1f}px off the sheet geometry")
+        if not MIN_SIZE_RATIO <= size <= MAX_SIZE_RATIO:
+            fail(i, "size", f"marker is {size:.2f}x the expected size")
+
+    if all(c is not None for c in centres):
+        # Quadrilateral through the marker centres, walked TL -> TR -> BR -> BL
+        order = (0, 1, 3, 2)
+        quad = [centres[i] for i in order]
+        for k, i in enumerate(order):
+            angle = _corner_angle(quad[k - 1], quad[k], quad[(k + 1) % 4])
+            corners[CORNERS[i]]["angle_deg"] = round(angle, 1)
+            if abs(angle - 90.0) > MAX_ANGLE_DEVIATION:
+                fail(i, "angle", f"sheet corner at {angle:.0f} degrees")
+        found_w = (np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])) / 2
+        found_h = (np.linalg.norm(quad[3] - quad[0]) + np.linalg.norm(quad[2] - quad[1])) / 2
+        aspect = (found_w / max(found_h, 1e-9)) / ((template_size[0] + 2 * outset) / (template_size[1] + 2 * outset))
+        if abs(aspect - 1.0) > MAX_ASPECT_DEVIATION:
+            fail(None, "aspect", f"sheet outline is {aspect:.2f}x the expected width/height ratio")
+
+    return _report(corners, failures, fiducials)
+
+def _report(corners, failures, fiducials):
+    reprojections = [c["reprojection_px"] for c in corners.values() if "reprojection_px" in c]
+    report = {
+        "ok": not failures,
+        "fiducials": fiducials,
+        "failed_corner": None,
+        "reason": None,
+        "message": "Alignment OK.",
+        "reprojection_px": max(reprojections) if reprojections else None,
+        "corners": corners,
+    }
+    if failures:
+        # Corner failures first, so the app can point at the corner to fix
+        corner, reason, detail = min(failures, key=lambda f: (f[0] is None, f[0] or 0))
+        where = f" at the {CORNERS[corner]} marker" if corner is not None else ""
+        report.update(failed_corner=CORNERS[corner] if corner is not None else None, reason=reason,
+                      message=f"Alignment failed{where}: {detail}. Retake the photo with all four corner markers visible.")
+    return report
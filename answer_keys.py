@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+from fill_reader import OPTIONS
+
+# === CONFIGURATION ===
+TEMPLATES_DB_PATH = os.environ.get("MCQ_TEMPLATES_DB", "templates.sqlite3")
+MAX_QUESTIONS = 30          # bubbles on the printed sheet
+COMPILED_CACHE_SIZE = 256
+
+# Marks as codes: options 0-4, blank -1, invalid (several bubbles) -2.
+# A key never contains a negative code, so blank/invalid never count as correct.
+BLANK, INVALID = -1, -2
+_MARK_CODES = {option: i for i, option in enumerate(OPTIONS)}
+_MARK_CODES.update({"INVALID": INVALID, "-": BLANK, "": BLANK})
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answer_keys (
+    course_code TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    answers TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (course_code, version)
+);
+"""
+
+
+class InvalidAnswerKey(ValueError):
+    pass
+
+
+class UnknownAnswerKey(LookupError):
+    pass
+
+
+# === COMPILED KEYS ===
+class CompiledKey:
+    # codes[q - 1] is the option index of question q's correct answer
+    def __init__(self, course_code, version, answers):
+        self.course_code = course_code
+        self.version = version
+        self.answers = list(answers)
+        self.codes = np.array([_MARK_CODES[a] for a in self.answers], dtype=np.int8)
+
+    @property
+    def total(self):
+        return len(self.codes)
+
+def compile_answers(answers):
+    # Validates a key given as ["A", "C", ...] (question 1 first)
+    answers = [str(a).strip().upper() for a in answers]
+    if not 1 <= len(answers) <= MAX_QUESTIONS:
+        raise InvalidAnswerKey(f"An answer key needs 1 to {MAX_QUESTIONS} answers, got {len(answers)}.")
+    bad = [f"Q{q}={a!r}" for q, a in enumerate(answers, start=1) if a not in OPTIONS]
+    if bad:
+        raise InvalidAnswerKey(f"Answers must be one of {list(OPTIONS)}: {', '.join(bad[:5])}")
+    return answers
+
+def encode_marks(marked_rows, width=MAX_QUESTIONS):
+    # (sheets, width) int8 matrix from each sheet's "answers" list; missing questions are blank
+    marks = np.full((len(marked_rows), width), BLANK, dtype=np.int8)
+    for i, row in enumerate(marked_rows):
+        codes = [_MARK_CODES.get(m, BLANK) for m in row[:width]]
+        marks[i, :len(codes)] = codes
+    return marks
+
+
+# === SCORING ===
+def _status(marked, correct):
+    if marked == correct:
+        return "Correct"
+    if marked == "INVALID":
+        return "Invalid Mark"
+    if marked and marked != "-":
+        return f"Wrong (marked {marked})"
+    return "Blank"
+
+def score_results(results, key):
+    # Rescores one sheet's results against `key` from its marked answers; no inference involved
+    return score_many([results], key)[0]
+
+def score_many(results_list, key):
+    # One vectorised comparison for a whole batch: (sheets, questions) marks vs the key.
+    # Sheets that failed to grade are returned unchanged.
+    gradable = [i for i, r in enumerate(results_list) if r.get("answers") and not r.get("error")]
+    marks = encode_marks([results_list[i]["answers"] for i in gradable], key.total)
+    scores = dict(zip(gradable, (marks == key.codes).sum(axis=1).tolist()))
+
+    rescored = []
+    for i, results in enumerate(results_list):
+        if i not in scores:
+            rescored.append(results)
+            continue
+        results = dict(results, score=scores[i], total=key.total,
+                       course_code=key.course_code, key_version=key.version)
+        if "details" in results:
+            details = []
+            for item in results["details"]:
+                q = item["question"]
+                correct = key.answers[q - 1] if q <= key.total else "?"
+                details.append(dict(item, correct=correct, status=_status(item["marked"], correct)))
+            results["details"] = details
+        rescored.append(results)
+    return rescored
+
+
+# === REGISTRY ===
+# Keys are versioned per course code: saving a key for a course adds the next version, and
+# lookups without a version get the latest. Compiled keys are cached by (course, version).
+class AnswerKeyRegistry:
+    def __init__(self, path=TEMPLATES_DB_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._compiled = {}
+
+    def add(self, course_code, answers):
+        answers = compile_answers(answers)
+        course_code = course_code.strip()
+        if not course_code:
+            raise InvalidAnswerKey("course_code is required.")
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                (latest,) = self._db.execute(
+                    "SELECT COALESCE(MAX(version), 0) FROM answer_keys WHERE course_code = ?",
+                    (course_code,)).fetchone()
+                self._db.execute(
+                    "INSERT INTO answer_keys (course_code, version, answers, created_at) VALUES (?, ?, ?, ?)",
+                    (course_code, latest + 1, json.dumps(answers), time.time()))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return CompiledKey(course_code, latest + 1, answers)
+
+    def get(self, course_code, version=None):
+        if version is not None and (course_code, version) in self._compiled:
+            return self._compiled[(course_code, version)]
+        with self._lock:
+            if version is None:
+                row = self._db.execute(
+                    "SELECT version, answers FROM answer_keys WHERE course_code = ? ORDER BY version DESC LIMIT 1",
+                    (course_code,)).fetchone()
+            else:
+                row = self._db.execute(
+                    "SELECT version, answers FROM answer_keys WHERE course_code = ? AND version = ?",
+                    (course_code, version)).fetchone()
+        if row is None:
+            suffix = f" version {version}" if version is not None else ""
+            raise UnknownAnswerKey(f"No answer key for course '{course_code}'{suffix}.")
+        with self._lock:
+            key = self._compiled.get((course_code, row[0]))
+            if key is None:
+                key = CompiledKey(course_code, row[0], json.loads(row[1]))
+                if len(self._compiled) >= COMPILED_CACHE_SIZE:
+                    self._compiled.pop(next(iter(self._compiled)))
+                self._compiled[(course_code, row[0])] = key
+        return key
+
+    def courses(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT course_code, MAX(version), COUNT(*) FROM answer_keys GROUP BY course_code ORDER BY course_code"
+            ).fetchall()
+        return [{"course_code": c, "latest_version": v, "versions": n} for c, v, n in rows]
+
+    def versions(self, course_code):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT version, answers, created_at FROM answer_keys WHERE course_code = ? ORDER BY version",
+                (course_code,)).fetchall()
+        return [{"version": v, "answers": json.loads(a), "created_at": t} for v, a, t in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from functools import partial
+
+from process_mcq_sheet import predict_mcq_batch, extract_reg_number_batch
+from stage_executor import run_stages
+
+# === CONFIGURATION ===
+# A batch is flushed as soon as it holds MAX_BATCH_SIZE sheets, or MAX_WAIT_MS after
+# its first sheet arrived, whichever comes first.
+MAX_BATCH_SIZE = int(os.environ.get("MCQ_BATCH_MAX_SIZE", "8"))
+MAX_WAIT_MS = float(os.environ.get("MCQ_BATCH_MAX_WAIT_MS", "20"))
+
+
+class _Job:
+    __slots__ = ("aligned", "reg_zone", "future")
+
+    def __init__(self, aligned, reg_zone):
+        self.aligned = aligned
+        self.reg_zone = reg_zone
+        self.future = Future()
+
+
+# === MICRO-BATCHING SCHEDULER ===
+# Collects aligned sheets from concurrent requests and runs one batched forward pass
+# for the bubble model and one for the reg-number model. Each request gets back
+# (reg_number, (boxes, confs, classes)) through its own future.
+class BatchScheduler:
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, aligned, reg_zone):
+        if self._thread is None:
+            raise RuntimeError("Batch scheduler is not running")
+        job = _Job(aligned, reg_zone)
+        self._queue.put(job)
+        return job.future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                # Put the stop sentinel back so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._collect(first)
+            jobs = [job for job in batch if job.future.set_running_or_notify_cancel()]
+            if not jobs:
+                continue
+            try:
+                reg_numbers, detections = run_stages(
+                    partial(extract_reg_number_batch, [job.reg_zone for job in jobs]),
+                    partial(predict_mcq_batch, [job.aligned for job in jobs]),
+                )
+            except Exception as e:
+                traceback.print_exc()
+                for job in jobs:
+                    job.future.set_exception(e)
+                continue
+            for job, reg_number, dets in zip(jobs, reg_numbers, detections):
+                job.future.set_result((reg_number, dets))
@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import os
+import tempfile
+import time
+import multiprocessing as mp
+import cv2
+import numpy as np
+
+from process_mcq_sheet import (
+    MCQ_MODEL_PATH, CONF_THRESHOLD_MCQ, REG_IMGSZ, ROI_IMGSZ, REGION_REG_NO, ANSWER_REGIONS,
+    TEMPLATE_WIDTH, TEMPLATE_HEIGHT, find_markers_and_align, find_homography, crop_zone,
+    region_scale, warp_region,
+)
+from model_registry import get_model
+from tiling import make_tiles, predict_tiled, TILE_BATCH
+from streaming_upload import read_base64_json
+from marker_search import locate_markers, locate_markers_full
+from fiducials import detect_fiducials, render_page, PAGE_MARGIN
+from alignment_quality import AlignmentRejected
+import homography_cache
+
+# === CONFIGURATION ===
+DEFAULT_IMAGES = "Test_images"
+
+
+def load_aligned(image_dir, limit=None):
+    # Sheets failing the alignment check are skipped
+    paths = sorted(glob.glob(os.path.join(image_dir, "*.jpg")))[:limit]
+    sheets = []
+    for p in paths:
+        try:
+            sheets.append(find_markers_and_align(cv2.imread(p)))
+        except AlignmentRejected:
+            pass
+    return sheets
+
+
+# === TILED INFERENCE THROUGHPUT ===
+def bench_tiling(args):
+    sheets = load_aligned(args.images, args.limit)
+    model = get_model(MCQ_MODEL_PATH)
+    predict_tiled(sheets[:1], model, CONF_THRESHOLD_MCQ)     # warm-up
+
+    print(f"{'tile':>6} {'overlap':>8} {'tiles/sheet':>12} {'sheets/s':>10} {'tiles/s':>10} {'boxes/sheet':>12}")
+    for tile in args.tile_sizes:
+        for overlap in args.overlaps:
+            if overlap >= tile:
+                continue
+            n_tiles = len(make_tiles(sheets[0].shape, tile, overlap))
+            start = time.perf_counter()
+            results = predict_tiled(sheets, model, CONF_THRESHOLD_MCQ, tile, overlap, args.batch)
+            elapsed = time.perf_counter() - start
+            boxes = sum(len(r[0]) for r in results) / len(sheets)
+            print(f"{tile:>6} {overlap:>8} {n_tiles:>12} {len(sheets) / elapsed:>10.2f} "
+                  f"{n_tiles * len(sheets) / elapsed:>10.1f} {boxes:>12.1f}")
+
+
+# === /grade_base64 INGESTION MEMORY ===
+def _rss_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+def _ingest_legacy(payload_path):
+    # What the old endpoint did: whole body -> pydantic str -> split -> b64decode -> temp file
+    with open(payload_path, "rb") as f:
+        body = f.read()
+    content = json.loads(body)["content"]
+    if content.startswith("data:image"):
+        content = content.split(";base64,")[-1]
+    image_bytes = base64.b64decode(content)
+    with tempfile.NamedTemporaryFile() as tmp:
+        tmp.write(image_bytes)
+    return len(image_bytes)
+
+def _ingest_streaming(payload_path, chunk_size=64 * 1024):
+    async def chunks():
+        with open(payload_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    _, image_bytes = asyncio.run(read_base64_json(chunks(), os.path.getsize(payload_path)))
+    return len(image_bytes)
+
+def _measure(fn, payload_path, out):
+    before = _rss_kb("VmRSS:")
+    start = time.perf_counter()
+    size = fn(payload_path)
+    out.put((size, time.perf_counter() - start, _rss_kb("VmHWM:") - before))
+
+def bench_ingest(args):
+    image_path = args.image or max(glob.glob(os.path.join(args.images, "*.jpg")), key=os.path.getsize)
+    with open(image_path, "rb") as f:
+        content = "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"filename": os.path.basename(image_path), "content": content}, f)
+        payload_path = f.name
+
+    # Each request runs in a fresh process so its peak RSS is measured in isolation
+    ctx = mp.get_context("spawn")
+    print(f"{'ingest':>10} {'image MB':>9} {'ms':>8} {'peak RSS MB':>12}")
+    try:
+        for name, fn in (("legacy", _ingest_legacy), ("streaming", _ingest_streaming)):
+            out = ctx.Queue()
+            p = ctx.Process(target=_measure, args=(fn, payload_path, out))
+            p.start()
+            size, elapsed, peak_kb = out.get()
+            p.join()
+            print(f"{name:>10} {size / 2**20:>9.2f} {elapsed * 1000:>8.1f} {peak_kb / 1024:>12.1f}")
+    finally:
+        os.remove(payload_path)
+
+
+# === MARKER SEARCH ===
+def bench_align(args):
+    # Upscaling the 1280 px test photos stands in for 12 MP phone captures
+    paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))[:args.limit]
+    grays = [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2GRAY) for p in paths]
+    grays = [cv2.resize(g, None, fx=args.upscale, fy=args.upscale, interpolation=cv2.INTER_CUBIC) for g in grays]
+
+    def run(locate):
+        times = [0.0] * len(grays)
+        for _ in range(args.repeat):
+            found = []
+            for i, g in enumerate(grays):
+                start = time.perf_counter()
+                found.append(locate(g))
+                times[i] += (time.perf_counter() - start) / args.repeat
+        return found, times
+
+    full, t_full = run(lambda g: locate_markers_full(g))
+    coarse, t_coarse = run(lambda g: locate_markers(g, "coarse"))
+    # Sheets without printed markers pay for the full-search fallback, so report both sets
+    marked = [i for i, f in enumerate(full) if f is not None]
+    shifts = [np.abs(np.subtract([m[:2] for m in full[i]], [m[:2] for m in coarse[i]])).max()
+              for i in marked if coarse[i] is not None]
+
+    def ms(times, idx):
+        return sum(times[i] for i in idx) / max(1, len(idx)) * 1000
+
+    everything = range(len(grays))
+    h, w = grays[0].shape
+    print(f"{len(grays)} images ({len(marked)} with markers), first {w}x{h}")
+    print(f"{'search':>8} {'ms/image':>9} {'ms/marked':>10} {'found':>6}")
+    for name, found, times in (("full", full, t_full), ("coarse", coarse, t_coarse)):
+        print(f"{name:>8} {ms(times, everything):>9.1f} {ms(times, marked):>10.1f} {sum(f is not None for f in found):>6}")
+    if shifts:
+        print(f"max marker shift coarse vs full: {max(shifts):.2f} px")
+
+
+# === ROI-DIRECT WARPING ===
+def bench_warp(args):
+    # Marker search excluded: both paths start from the same homography
+    paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))[:args.limit]
+    images = [cv2.resize(cv2.imread(p), None, fx=args.upscale, fy=args.upscale, interpolation=cv2.INTER_CUBIC)
+              for p in paths]
+    sheets = []
+    for img in images:
+        try:
+            sheets.append((img, find_homography(img)))
+        except AlignmentRejected:
+            pass
+    targets = [(REGION_REG_NO, REG_IMGSZ)] + [(r, ROI_IMGSZ) for r in ANSWER_REGIONS]
+
+    def full(img, M):
+        aligned = cv2.warpPerspective(img, M, (TEMPLATE_WIDTH, TEMPLATE_HEIGHT))
+        return aligned, [crop_zone(aligned, region) for region, _ in targets]
+
+    def direct(img, M):
+        return None, [warp_region(img, M, region, region_scale(region, imgsz)) for region, imgsz in targets]
+
+    def run(fn):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            out = [fn(img, M) for img, M in sheets]
+        return out, (time.perf_counter() - start) / (args.repeat * len(sheets))
+
+    full_out, t_full = run(full)
+    direct_out, t_direct = run(direct)
+    full_mb = sum(a.nbytes for a, _ in full_out) / len(sheets) / 2**20
+    direct_mb = sum(sum(c.nbytes for c in crops) for _, crops in direct_out) / len(sheets) / 2**20
+
+    # Fidelity: full-warp crops resized as the model's letterbox would vs the direct warps
+    diffs = []
+    for (_, crops), (_, warped) in zip(full_out, direct_out):
+        for crop, w in zip(crops, warped):
+            ref = cv2.resize(crop, (w.shape[1], w.shape[0]), interpolation=cv2.INTER_LINEAR)
+            diffs.append(np.abs(ref.astype(np.int16) - w).mean())
+
+    h, w = sheets[0][0].shape[:2]
+    print(f"{len(sheets)} aligned sheets, first {w}x{h}")
+    print(f"{'warp':>8} {'ms/sheet':>9} {'MB/sheet':>9}")
+    print(f"{'full':>8} {t_full * 1000:>9.1f} {full_mb:>9.1f}")
+    print(f"{'regions':>8} {t_direct * 1000:>9.1f} {direct_mb:>9.1f}")
+    print(f"mean abs pixel difference vs full warp + resize: {np.mean(diffs):.2f} (max region {np.max(diffs):.2f})")
+
+
+# === ARUCO FIDUCIALS ===
+def bench_fiducials(args):
+    # Test sheets re-printed with ArUco markers and photographed through a known random
+    # perspective; the detected homography is checked against that ground truth
+    rng = np.random.default_rng(0)
+    sheets = [a for a in load_aligned(args.images, args.limit) if a.shape[:2] == (TEMPLATE_HEIGHT, TEMPLATE_WIDTH)]
+    photos = []
+    for sheet in sheets:
+        page = render_page(sheet, 0, 0)
+        ph, pw = page.shape[:2]
+        src = np.float32([[0, 0], [pw, 0], [0, ph], [pw, ph]])
+        out_w, out_h = int(3000 * args.scale), int(4000 * args.scale)
+        dst = np.float32([[0.08, 0.06], [0.92, 0.05], [0.05, 0.95], [0.95, 0.93]]) * [out_w, out_h]
+        dst += rng.uniform(-0.03, 0.03, dst.shape).astype(np.float32) * [out_w, out_h]
+        page_to_photo = cv2.getPerspectiveTransform(src, dst.astype(np.float32))
+        photo = cv2.warpPerspective(page, page_to_photo, (out_w, out_h), borderValue=(200, 200, 200))
+        # aligned frame -> page is a shift by the page margin
+        frame_to_page = np.array([[1, 0, PAGE_MARGIN], [0, 1, PAGE_MARGIN], [0, 0, 1]], dtype=np.float64)
+        photos.append((cv2.cvtColor(photo, cv2.COLOR_BGR2GRAY), page_to_photo @ frame_to_page))
+
+    grid = np.float32([[x, y] for x in np.linspace(0, TEMPLATE_WIDTH, 9) for y in np.linspace(0, TEMPLATE_HEIGHT, 9)])
+    found, errors = 0, []
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        results = [detect_fiducials(gray) for gray, _ in photos]
+    elapsed = (time.perf_counter() - start) / (args.repeat * len(photos))
+    for result, (_, frame_to_photo) in zip(results, photos):
+        if result is None:
+            continue
+        found += 1
+        M = result.homography(TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
+        # Template grid -> photo (truth) -> template (detected): residual in template px
+        back = cv2.perspectiveTransform(cv2.perspectiveTransform(grid[None], frame_to_photo), M)[0]
+        errors.append(np.linalg.norm(back - grid, axis=1).max())
+
+    print(f"{len(photos)} synthetic photos, {photos[0][0].shape[1]}x{photos[0][0].shape[0]}")
+    print(f"detected {found}/{len(photos)}, {elapsed * 1000:.1f} ms/photo")
+    if errors:
+        print(f"max template-frame error: {max(errors):.2f} px (mean of per-sheet max {np.mean(errors):.2f} px)")
+
+
+# === HOMOGRAPHY CACHE ===
+def bench_homography(args):
+    # A fixed rig: each marker sheet is re-shot --frames times in place (fresh sensor noise each
+    # time), then once moved by --shift px, which must not reuse the cached transform
+    rng = np.random.default_rng(0)
+    paths = sorted(glob.glob(os.path.join(args.images, "*.jpg")))[:args.limit]
+    runs = []
+    for p in paths:
+        image = cv2.resize(cv2.imread(p), None, fx=args.upscale, fy=args.upscale, interpolation=cv2.INTER_CUBIC)
+        try:
+            find_homography(image)
+        except AlignmentRejected:
+            continue
+        frames = [np.clip(image + rng.normal(0, 3, image.shape), 0, 255).astype(np.uint8) for _ in range(args.frames)]
+        frames.append(np.roll(image, args.shift, axis=1))
+        runs.append(frames)
+
+    def run(enabled):
+        homography_cache.ALIGN_CACHE = enabled
+        homography_cache._cache = homography_cache.HomographyCache(args.map_mb * 2**20, args.map_after)
+        hits_before = homography_cache.LOOKUPS._values.get(("hit",), 0)
+        start = time.perf_counter()
+        aligned = [[find_markers_and_align(f) for f in frames] for frames in runs]
+        elapsed = (time.perf_counter() - start) / sum(len(f) for f in runs)
+        return aligned, elapsed, homography_cache.LOOKUPS._values.get(("hit",), 0) - hits_before
+
+    # Off and on alternate, best of --repeat each, so drift in machine load hits both alike
+    t_off = t_on = float("inf")
+    for _ in range(args.repeat):
+        fresh, t, _ = run(False)
+        t_off = min(t_off, t)
+        cached, t, hits = run(True)
+        t_on = min(t_on, t)
+    in_place = [np.abs(a.astype(np.int16) - b).mean() for fa, fb in zip(fresh, cached) for a, b in zip(fa[:-1], fb[:-1])]
+    moved = [np.abs(fa[-1].astype(np.int16) - fb[-1]).mean() for fa, fb in zip(fresh, cached)]
+
+    frames = sum(len(f) for f in runs)
+    print(f"{len(runs)} sheets x {args.frames} in-place shots + 1 shifted by {args.shift}px, "
+          f"{runs[0][0].shape[1]}x{runs[0][0].shape[0]}")
+    print(f"{'cache':>6} {'ms/sheet':>9} {'hits':>6}")
+    print(f"{'off':>6} {t_off * 1000:>9.1f} {0:>6}")
+    print(f"{'on':>6} {t_on * 1000:>9.1f} {hits:>3}/{frames}")
+    print(f"mean abs difference vs fresh alignment: in place {max(in_place):.3f}, shifted {max(moved):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grading pipeline benchmarks.")
+    parser.add_argument("--images", default=DEFAULT_IMAGES)
+    parser.add_argument("--limit", type=int, default=None)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    tiling = sub.add_parser("tiling", help="Tiled bubble-detection throughput per tile count")
+    tiling.add_argument("--tile-sizes", type=int, nargs="+", default=[512, 640, 960])
+    tiling.add_argument("--overlaps", type=int, nargs="+", default=[144, 192])
+    tiling.add_argument("--batch", type=int, default=TILE_BATCH)
+    tiling.set_defaults(func=bench_tiling)
+
+    ingest = sub.add_parser("ingest", help="Peak RSS per /grade_base64 request, legacy vs streaming decode")
+    ingest.add_argument("--image", default=None, help="Defaults to the largest image in --images")
+    ingest.set_defaults(func=bench_ingest)
+
+    align = sub.add_parser("align", help="Full-image vs coarse-to-fine marker search time and success")
+    align.add_argument("--upscale", type=float, default=3.0)
+    align.add_argument("--repeat", type=int, default=3)
+    align.set_defaults(func=bench_align)
+
+    warp = sub.add_parser("warp", help="Whole-sheet warp vs ROI-direct region warps: time, memory, fidelity")
+    warp.add_argument("--upscale", type=float, default=3.0)
+    warp.add_argument("--repeat", type=int, default=3)
+    warp.set_defaults(func=bench_warp)
+
+    fid = sub.add_parser("fiducials", help="ArUco detection time and homography accuracy on synthetic photos")
+    fid.add_argument("--scale", type=float, default=1.0, help="Photo size relative to 3000x4000")
+    fid.add_argument("--repeat", type=int, default=3)
+    fid.set_defaults(func=bench_fiducials)
+
+    hom = sub.add_parser("homography", help="Align + warp time with and without the previous-transform cache")
+    hom.add_argument("--upscale", type=float, default=3.0)
+    hom.add_argument("--frames", type=int, default=5)
+    hom.add_argument("--shift", type=int, default=4)
+    hom.add_argument("--repeat", type=int, default=3)
+    hom.add_argument("--map-after", type=int, default=homography_cache.MAP_AFTER_USES)
+    hom.add_argument("--map-mb", type=float, default=homography_cache.MAP_CACHE_MB)
+    hom.set_defaults(func=bench_homography)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import numpy as np
+
+from metrics import timed
+
+from fill_reader import (
+    BUBBLE_X_Q1_15, BUBBLE_X_Q16_30, BUBBLE_ROW_Y, BUBBLE_RADIUS, FILL_THRESHOLD,
+    fill_ratios, ratios_to_question_map,
+)
+
+# === CONFIGURATION ===
+# The fill-ratio reader decides every question it is sure about; the rest go to the bubble
+# detector in one small batch. A question is settled by the fill ratios when it is clearly
+# blank (best bubble below CASCADE_BLANK_MAX) or clearly single-marked (exactly one bubble above
+# FILL_THRESHOLD, ahead of the runner-up by at least CASCADE_MARGIN).
+CASCADE_BLANK_MAX = 0.2
+CASCADE_MARGIN = 0.35
+
+# Each ambiguous question is cropped with one row of context above and below, and run at about
+# the scale the detector saw in training (a 3508 px sheet letterboxed to 640; ~0.21 here, as
+# ROI mode's columns run at ~0.19)
+ROW_PITCH = (BUBBLE_ROW_Y[-1] - BUBBLE_ROW_Y[0]) / (len(BUBBLE_ROW_Y) - 1)
+CROP_PAD = BUBBLE_RADIUS + 10
+CASCADE_IMGSZ = (128, 192)
+
+
+def ambiguous_questions(ratios):
+    # 1-based question numbers whose fill ratios don't settle the answer
+    ordered = np.sort(ratios, axis=1)
+    top, runner_up = ordered[:, -1], ordered[:, -2]
+    n_filled = (ratios >= FILL_THRESHOLD).sum(axis=1)
+    blank = top < CASCADE_BLANK_MAX
+    single = (n_filled == 1) & (top - runner_up >= CASCADE_MARGIN)
+    return [int(q) + 1 for q in np.flatnonzero(~(blank | single))]
+
+def question_crop_box(question, shape):
+    xs = BUBBLE_X_Q1_15 if question <= 15 else BUBBLE_X_Q16_30
+    row_y = BUBBLE_ROW_Y[(question - 1) % 15]
+    h, w = shape[:2]
+    x1, x2 = max(0, xs[0] - CROP_PAD), min(w, xs[-1] + CROP_PAD)
+    y1 = max(0, int(row_y - ROW_PITCH - CROP_PAD))
+    y2 = min(h, int(row_y + ROW_PITCH + CROP_PAD))
+    return x1, y1, x2, y2, row_y
+
+
+@timed("read_cascade", "model")
+def read_cascade(aligned, model, conf, class_names):
+    # Returns (question_map, sources); sources[q] is "cascade" or "model"
+    ratios = fill_ratios(aligned)
+    question_map = ratios_to_question_map(ratios)
+    sources = {q: "cascade" for q in question_map}
+
+    ambiguous = ambiguous_questions(ratios)
+    if not ambiguous:
+        return question_map, sources
+
+    boxes = [question_crop_box(q, aligned.shape) for q in ambiguous]
+    crops = [aligned[y1:y2, x1:x2] for x1, y1, x2, y2, _ in boxes]
+    outputs = model.predict(crops, conf=conf, imgsz=CASCADE_IMGSZ)
+
+    for q, (_, y1, _, _, row_y), (xyxy, confs, classes) in zip(ambiguous, boxes, outputs):
+        # Only detections centred on the question's own row count
+        cy = (xyxy[:, 1] + xyxy[:, 3]) / 2 + y1
+        on_row = np.flatnonzero(np.abs(cy - row_y) < ROW_PITCH / 2)
+        if len(on_row):
+            best = on_row[np.argmax(confs[on_row])]
+            question_map[q] = [class_names[int(classes[best])], float(confs[best])]
+        else:
+            question_map[q] = ["", 0.0]
+        sources[q] = "model"
+    return question_map, sources
@@ -0,0 +1,103 @@
+import os
+import re
+import uuid
+import queue
+import random
+import threading
+
+import cv2
+
+from metrics import Counter
+
+# === CONFIGURATION ===
+# Debug images (aligned sheet, zone crops) are off unless a request asks for them or is sampled
+DEBUG_DIR = os.environ.get("MCQ_DEBUG_DIR", "debug_outputs")
+DEBUG_SAMPLE_RATE = float(os.environ.get("MCQ_DEBUG_SAMPLE_RATE", "0"))
+# Images waiting to be encoded; when full, new artifacts are dropped rather than slowing grading
+DEBUG_QUEUE_SIZE = int(os.environ.get("MCQ_DEBUG_QUEUE_SIZE", "16"))
+JPEG_QUALITY = 90
+
+ARTIFACTS = Counter("mcq_debug_artifacts_total", "Debug images by outcome (written, dropped, failed)", ["result"])
+
+_SAFE_ID = re.compile(r"[^A-Za-z0-9_-]")
+
+
+def new_request_id(requested=None):
+    # A client-supplied ID is kept (made filename-safe); otherwise a fresh one
+    if requested:
+        cleaned = _SAFE_ID.sub("", requested)[:64]
+        if cleaned:
+            return cleaned
+    return uuid.uuid4().hex[:16]
+
+
+# === BACKGROUND WRITER ===
+# One thread per process encodes and writes queued images, off the grading path
+class ArtifactWriter:
+    def __init__(self, directory=DEBUG_DIR, max_queue=DEBUG_QUEUE_SIZE):
+        self.directory = directory
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, filename, image):
+        self._ensure_started()
+        try:
+            # Copied: the pipeline's buffers may be reused (or be shared memory) once it returns
+            self._queue.put_nowait((filename, image.copy()))
+        except queue.Full:
+            ARTIFACTS.inc("dropped")
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="debug-artifacts", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            filename, image = item
+            try:
+                ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+                if not ok:
+                    raise ValueError("JPEG encode failed")
+                encoded.tofile(os.path.join(self.directory, filename))
+                ARTIFACTS.inc("written")
+            except Exception as e:
+                ARTIFACTS.inc("failed")
+                print(f"⚠️ Debug artifact {filename} not written:", str(e))
+
+    def shutdown(self, timeout=5):
+        # Write what is already queued, then stop
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+_writer = ArtifactWriter()
+
+def shutdown():
+    _writer.shutdown()
+
+
+# === PER-REQUEST HANDLE ===
+# Passed down the pipeline as `debug`; None (the default everywhere) means no artifacts.
+# Files are named <request_id>_<name>.jpg so concurrent requests never overwrite each other.
+class DebugArtifacts:
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def save(self, name, image):
+        if image is None or image.size == 0:
+            return
+        _writer.submit(f"{self.request_id}_{name}.jpg", image)
+
+def artifacts_for(request_id, requested=False, sample_rate=DEBUG_SAMPLE_RATE):
+    if requested or (sample_rate > 0 and random.random() < sample_rate):
+        return DebugArtifacts(request_id)
+    return None
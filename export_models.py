@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import shutil
+from ultralytics import YOLO
+
+from process_mcq_sheet import MCQ_MODEL_PATH, REG_MODEL_PATH, MCQ_INFERENCE_MODE, ROI_IMGSZ, REG_IMGSZ
+from inference_engines import onnx_path, openvino_path, metadata_path
+from tiling import TILE_SIZE
+
+# === CONFIGURATION ===
+DEFAULT_IMGSZ = [640]     # one value for a square input, or H W (e.g. 576 224 for ROI mode)
+DEFAULT_BATCH = 8       # fixed batch of the exported graph; engines pad/chunk to it
+
+
+# === EXPORT ===
+def model_imgsz(pt_path):
+    # The input size each model's callers ask for: the reg-number model always reads a 640x640 box,
+    # the bubble detector whatever MCQ_INFERENCE_MODE feeds it
+    if pt_path == REG_MODEL_PATH:
+        return list(REG_IMGSZ)
+    if MCQ_INFERENCE_MODE == "roi":
+        return list(ROI_IMGSZ)
+    if MCQ_INFERENCE_MODE == "tiled":
+        return [TILE_SIZE]
+    return DEFAULT_IMGSZ
+
+def _export_imgsz(imgsz):
+    return imgsz[0] if len(imgsz) == 1 else list(imgsz)
+
+
+# Turns the .pt weights into fixed-shape graphs for the onnxruntime / openvino engines:
+#   models/foo.pt -> models/foo.onnx, models/foo_openvino_model/foo.xml, models/foo.export.json
+def export_model(pt_path, formats, imgsz=DEFAULT_IMGSZ, batch=DEFAULT_BATCH):
+    model = YOLO(pt_path)
+    exported = {}
+
+    if "onnx" in formats:
+        out = model.export(format="onnx", imgsz=_export_imgsz(imgsz), batch=batch, dynamic=False, simplify=True)
+        if os.path.abspath(out) != os.path.abspath(onnx_path(pt_path)):
+            shutil.move(out, onnx_path(pt_path))
+        exported["onnxruntime"] = onnx_path(pt_path)
+
+    if "openvino" in formats:
+        model.export(format="openvino", imgsz=_export_imgsz(imgsz), batch=batch, dynamic=False, half=False)
+        if not os.path.exists(openvino_path(pt_path)):
+            raise FileNotFoundError(f"OpenVINO export did not produce {openvino_path(pt_path)}")
+        exported["openvino"] = openvino_path(pt_path)
+
+    meta = {
+        "source": pt_path,
+        "imgsz": imgsz if len(imgsz) == 2 else imgsz * 2,
+        "batch": batch,
+        "names": {str(k): v for k, v in model.names.items()},
+    }
+    with open(metadata_path(pt_path), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    for engine, path in exported.items():
+        print(f"✅ {pt_path} -> {path} ({engine})")
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the bubble and reg-number detectors to fixed-shape graphs.")
+    parser.add_argument("--formats", nargs="+", choices=["onnx", "openvino"], default=["onnx", "openvino"])
+    parser.add_argument("--imgsz", type=int, nargs="+", default=None,
+                        help="input size for every model (default: the size each model's callers use)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH)
+    parser.add_argument("--models", nargs="+", default=[MCQ_MODEL_PATH, REG_MODEL_PATH])
+    args = parser.parse_args()
+
+    for pt_path in args.models:
+        export_model(pt_path, args.formats, args.imgsz or model_imgsz(pt_path), args.batch)
+
+
+if __name__ == "__main__":
+    main()
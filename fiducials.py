@@ -0,0 +1,124 @@
+import os
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+from marker_search import COARSE_LONG_SIDE
+
+# === CONFIGURATION ===
+# "squares" finds the plain printed corner squares (marker_search.py); "aruco" reads ArUco markers,
+# whose IDs also say which template and page the photo shows; "auto" tries ArUco, then the squares
+FIDUCIAL_MODE = os.environ.get("MCQ_FIDUCIALS", "squares").lower()
+ARUCO_DICT = cv2.aruco.DICT_4X4_1000
+MAX_PAGES = 4               # pages per template the IDs can encode
+MARKER_SIDE = 160           # printed marker side in aligned-template px (300 dpi)
+# Marker centres sit this far outside each frame corner, on both axes, so a marker and its
+# half-marker quiet zone lie wholly in the page margin and never cover template content
+MARKER_OUTSET = MARKER_SIDE
+PAGE_MARGIN = MARKER_OUTSET + MARKER_SIDE       # white margin render_page adds around the template
+MIN_MARKERS = 3             # of one template/page; 3 markers are still 12 corners
+SUBPIX_MAX_WINDOW = 15      # px; half window of the full-resolution corner refinement
+
+CORNERS = ("top-left", "top-right", "bottom-left", "bottom-right")
+
+_local = threading.local()
+
+
+# === MARKER IDS ===
+# id = (template_id * MAX_PAGES + page) * 4 + corner, so every marker on the sheet names the
+# layout it belongs to and which corner it sits at
+def marker_id(template_id, page, corner):
+    return (template_id * MAX_PAGES + page) * 4 + corner
+
+def decode_id(value):
+    sheet, corner = divmod(int(value), 4)
+    template_id, page = divmod(sheet, MAX_PAGES)
+    return template_id, page, corner
+
+def template_points(corner, width, height, side=MARKER_SIDE, outset=0):
+    # A marker's four corners in the aligned frame, in ArUco order (TL, TR, BR, BL). The plain
+    # squares are centred on the frame corners (outset 0); ArUco markers sit MARKER_OUTSET outside.
+    cx = (-outset, width + outset, -outset, width + outset)[corner]
+    cy = (-outset, -outset, height + outset, height + outset)[corner]
+    h = side / 2
+    return np.array([[cx - h, cy - h], [cx + h, cy - h], [cx + h, cy + h], [cx - h, cy + h]], dtype=np.float32)
+
+
+# === DETECTION ===
+class Fiducials:
+    # Markers of one template/page found in a photo: corner index -> 4x2 photo points
+    def __init__(self, template_id, page, points):
+        self.template_id = template_id
+        self.page = page
+        self.points = points
+
+    def homography(self, width, height):
+        # Least squares over every marker corner; no RANSAC, so the same photo always gives the same M
+        src = np.concatenate([self.points[c] for c in sorted(self.points)])
+        dst = np.concatenate([template_points(c, width, height, outset=MARKER_OUTSET) for c in sorted(self.points)])
+        M, _ = cv2.findHomography(src, dst, 0)
+        return M
+
+def _detector():
+    # ArucoDetector keeps scratch state, so one per thread
+    detector = getattr(_local, "detector", None)
+    if detector is None:
+        dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+        detector = _local.detector = cv2.aruco.ArucoDetector(dictionary, cv2.aruco.DetectorParameters())
+    return detector
+
+def detect_fiducials(gray):
+    # Markers are found on a COARSE_LONG_SIDE copy, then every corner is refined to sub-pixel
+    # accuracy on the full-resolution image. None unless MIN_MARKERS of one template/page are seen.
+    h, w = gray.shape[:2]
+    scale = min(1.0, COARSE_LONG_SIDE / max(h, w))
+    small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    corners, ids, _ = _detector().detectMarkers(small)
+    if ids is None:
+        return None
+
+    sheets = {}
+    for quad, value in zip(corners, ids.ravel()):
+        template_id, page, corner = decode_id(value)
+        sheets.setdefault((template_id, page), {})[corner] = quad.reshape(4, 2) / scale
+    (template_id, page), points = max(sheets.items(), key=lambda item: len(item[1]))
+    if len(points) < MIN_MARKERS:
+        return None
+
+    # The coarse corners are off by up to ~1/scale px; the window has to cover that
+    half = int(min(SUBPIX_MAX_WINDOW, max(3, np.ceil(2 / scale))))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+    for corner, quad in points.items():
+        quad = np.ascontiguousarray(quad, dtype=np.float32)
+        cv2.cornerSubPix(gray, quad, (half, half), (-1, -1), criteria)
+        points[corner] = quad
+    return Fiducials(template_id, page, points)
+
+
+# === PRINTING ===
+def render_page(sheet, template_id, page, side=MARKER_SIDE):
+    # The aligned template with a white margin holding the four ArUco markers just outside its
+    # corners, each inside a white quiet zone half a marker wide that ends at the template's edge
+    dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+    height, width = sheet.shape[:2]
+    outset = side * MARKER_OUTSET // MARKER_SIDE
+    margin = outset + side
+    page_img = np.full((height + 2 * margin, width + 2 * margin) + sheet.shape[2:], 255, dtype=np.uint8)
+    page_img[margin:margin + height, margin:margin + width] = sheet
+    for corner in range(len(CORNERS)):
+        marker = cv2.aruco.generateImageMarker(dictionary, marker_id(template_id, page, corner), side)
+        if sheet.ndim == 3:
+            marker = cv2.cvtColor(marker, cv2.COLOR_GRAY2BGR)
+        x, y = template_points(corner, width, height, side, outset)[0].astype(int) + margin
+        quiet = side // 2
+        page_img[max(0, y - quiet):y + side + quiet, max(0, x - quiet):x + side + quiet] = 255
+        page_img[y:y + side, x:x + side] = marker
+    return page_img
+
+if __name__ == "__main__":
+    # python fiducials.py <template image> <template id> <page> <output>
+    src, template_id, page, out = sys.argv[1:5]
+    cv2.imwrite(out, render_page(cv2.imread(src), int(template_id), int(page)))
+    print(f"✅ Wrote {out}")
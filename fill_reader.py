@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+
+from metrics import timed
+
+# === TEMPLATE GEOMETRY (aligned 2480x3508 frame) ===
+# Bubble centres measured on the printed template; options A-E left to right, 15 rows per column.
+BUBBLE_X_Q1_15 = (311, 503, 690, 878, 1067)
+BUBBLE_X_Q16_30 = (1586, 1775, 1960, 2146, 2336)
+BUBBLE_ROW_Y = (437, 639, 846, 1058, 1265, 1469, 1671, 1885, 2090, 2299, 2510, 2716, 2924, 3133, 3345)
+BUBBLE_RADIUS = 72
+SAMPLE_HALF = 40        # half-side of the sampled square; stays inside the printed ring
+
+OPTIONS = ["A", "B", "C", "D", "E"]
+
+# A bubble counts as filled above FILL_THRESHOLD; two filled bubbles make the question INVALID
+FILL_THRESHOLD = 0.45
+
+
+def bubble_centres():
+    # (30, 5, 2) array of (x, y) centres, question-major
+    left = [[(x, y) for x in BUBBLE_X_Q1_15] for y in BUBBLE_ROW_Y]
+    right = [[(x, y) for x in BUBBLE_X_Q16_30] for y in BUBBLE_ROW_Y]
+    return np.array(left + right, dtype=np.int32)
+
+_CENTRES = bubble_centres()
+
+
+# === FILL RATIOS ===
+def binarize(aligned):
+    gray = aligned if aligned.ndim == 2 else cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    _, binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return binary
+
+def fill_ratios(aligned, centres=_CENTRES, half=SAMPLE_HALF):
+    # Dark-pixel fraction inside the square around each centre, from one integral image:
+    # every bubble is 4 lookups, all bubbles in one vectorised expression
+    integral = cv2.integral(binarize(aligned))
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    x1 = np.clip(centres[..., 0] - half, 0, w)
+    x2 = np.clip(centres[..., 0] + half, 0, w)
+    y1 = np.clip(centres[..., 1] - half, 0, h)
+    y2 = np.clip(centres[..., 1] + half, 0, h)
+    dark = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    area = np.maximum((x2 - x1) * (y2 - y1), 1)
+    return dark / area
+
+
+# === QUESTION MAP ===
+def ratios_to_question_map(ratios, threshold=FILL_THRESHOLD):
+    # Same structure as map_bubbles_to_questions: {question: [option, confidence]}
+    question_map = {}
+    for q, row in enumerate(ratios, start=1):
+        filled = np.flatnonzero(row >= threshold)
+        if len(filled) == 0:
+            question_map[q] = ["", 0.0]
+        elif len(filled) > 1:
+            question_map[q] = ["INVALID", float(row[filled].max())]
+        else:
+            question_map[q] = [OPTIONS[filled[0]], float(row[filled[0]])]
+    return question_map
+
+@timed("read_fill")
+def read_bubbles(aligned):
+    return ratios_to_question_map(fill_ratios(aligned))
@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from metrics import Counter
+
+# === CONFIGURATION ===
+# Opt-in for fixed rigs (document cameras, flatbeds), where sheets land where the previous one did;
+# handheld photos never hit it. The last accepted transform is tried first: a small window at each
+# of its markers is phase-correlated with the same window of the new photo, and the transform is
+# reused when no marker moved more than MAX_DRIFT_PX.
+ALIGN_CACHE = os.environ.get("MCQ_ALIGN_CACHE", "0") == "1"
+MAX_DRIFT_PX = float(os.environ.get("MCQ_ALIGN_CACHE_DRIFT_PX", "1.0"))     # photo px
+MIN_RESPONSE = 0.3              # phase-correlation peak; lower means the window shows something else
+WINDOW_MARKER_SIDES = 3         # check window side, in marker sides
+WINDOW_MIN = 32                 # px
+# A warp through precomputed cv2.remap maps costs about two thirds of a warpPerspective, and
+# building the maps about half of one, so they are built on a transform's MAP_AFTER_USES-th warp:
+# by default its first cache hit, the first evidence the rig is reusing it
+MAP_AFTER_USES = int(os.environ.get("MCQ_ALIGN_CACHE_MAP_AFTER", "2"))
+MAP_ROWS = 64                   # rows per block when building maps
+MAP_CACHE_MB = float(os.environ.get("MCQ_ALIGN_CACHE_MAP_MB", "64"))
+
+LOOKUPS = Counter("mcq_align_cache_total", "Alignment cache lookups by result (hit, miss)", ["result"])
+
+
+def _window(quad, shape):
+    h, w = shape[:2]
+    quad = np.asarray(quad, dtype=np.float64)
+    cx, cy = quad.mean(axis=0)
+    side = max(WINDOW_MIN, int(WINDOW_MARKER_SIDES * np.sqrt(abs(cv2.contourArea(quad.astype(np.float32))))))
+    half = side // 2
+    x1, y1 = max(0, int(cx) - half), max(0, int(cy) - half)
+    return x1, y1, min(w, x1 + 2 * half), min(h, y1 + 2 * half)
+
+def _gray_crop(image, window):
+    # Only the check window is converted, never the whole frame
+    x1, y1, x2, y2 = window
+    crop = image[y1:y2, x1:x2]
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    return np.float32(crop)
+
+def _remap_maps(M, size):
+    # For every destination pixel, where warpPerspective(image, M, size) would sample the photo,
+    # as fixed-point remap maps. Built MAP_ROWS rows at a time through cv2.perspectiveTransform,
+    # each block's row offset folded into the matrix, so no frame-sized float grid is needed.
+    w, h = size
+    inv = np.linalg.inv(M)
+    base = np.dstack(np.meshgrid(np.arange(w, dtype=np.float32), np.arange(MAP_ROWS, dtype=np.float32)))
+    map_xy = np.empty((h, w, 2), dtype=np.int16)
+    map_frac = np.empty((h, w), dtype=np.uint16)
+    for y in range(0, h, MAP_ROWS):
+        n = min(MAP_ROWS, h - y)
+        shift = np.array([[1, 0, 0], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+        points = cv2.perspectiveTransform(base[:n], inv @ shift)
+        map_xy[y:y + n], map_frac[y:y + n] = cv2.convertMaps(points, None, cv2.CV_16SC2)
+    return map_xy, map_frac
+
+
+# === CACHE ===
+# One entry per process: the last sheet that passed the alignment check. Its warps are keyed by
+# the exact matrix bytes, so the full-sheet warp and each ROI warp get their own maps.
+class HomographyCache:
+    def __init__(self, max_map_bytes=MAP_CACHE_MB * 2**20, map_after=MAP_AFTER_USES):
+        self.max_map_bytes = int(max_map_bytes)
+        self.map_after = map_after
+        self._entry = None
+        self._maps = OrderedDict()
+        self._map_bytes = 0
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def remember(self, image, fiducials, M, report, quads):
+        # quads: the four markers' photo-space corners; sheets with a marker missing aren't cached
+        if any(q is None for q in quads):
+            return
+        windows = [_window(q, image.shape) for q in quads]
+        patches = [_gray_crop(image, win) for win in windows]
+        hann = [cv2.createHanningWindow((p.shape[1], p.shape[0]), cv2.CV_32F) for p in patches]
+        entry = {"shape": image.shape[:2], "fiducials": fiducials, "M": M, "report": report,
+                 "windows": windows, "patches": patches, "hann": hann}
+        with self._lock:
+            self._entry = entry
+            self._maps.clear()
+            self._map_bytes = 0
+            self._uses.clear()
+
+    def lookup(self, image, fiducials):
+        # (M, report) of the cached sheet if every marker is still where it was, else None
+        with self._lock:
+            entry = self._entry
+        if entry is None or entry["shape"] != image.shape[:2] or entry["fiducials"] != fiducials:
+            LOOKUPS.inc("miss")
+            return None
+        for window, cached, hann in zip(entry["windows"], entry["patches"], entry["hann"]):
+            (dx, dy), response = cv2.phaseCorrelate(cached, _gray_crop(image, window), hann)
+            if response < MIN_RESPONSE or np.hypot(dx, dy) > MAX_DRIFT_PX:
+                LOOKUPS.inc("miss")
+                return None
+        LOOKUPS.inc("hit")
+        return entry["M"], entry["report"]
+
+    def warp(self, image, M, size):
+        # warpPerspective, or cv2.remap over maps once the same transform has come round
+        # map_after times since the cached sheet was remembered
+        key = (size, M.tobytes())
+        with self._lock:
+            maps = self._maps.get(key)
+            uses = self._uses.get(key, 0) + 1
+            if maps is None and len(self._uses) >= 64:
+                # Transforms that were never remembered (e.g. graded with MCQ_ALIGN_CHECK=0)
+                self._uses.clear()
+            self._uses[key] = uses
+        if maps is None and uses >= self.map_after and self.max_map_bytes > 0:
+            maps = _remap_maps(M, size)
+            nbytes = maps[0].nbytes + maps[1].nbytes
+            with self._lock:
+                if nbytes <= self.max_map_bytes:
+                    self._maps[key] = maps
+                    self._map_bytes += nbytes
+                    while self._map_bytes > self.max_map_bytes:
+                        _, (m1, m2) = self._maps.popitem(last=False)
+                        self._map_bytes -= m1.nbytes + m2.nbytes
+        if maps is None:
+            return cv2.warpPerspective(image, M, size)
+        return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR)
+
+_cache = HomographyCache()
+
+def lookup(image, fiducials):
+    return _cache.lookup(image, fiducials) if ALIGN_CACHE else None
+
+def remember(image, fiducials, M, report, quads):
+    if ALIGN_CACHE:
+        _cache.remember(image, fiducials, M, report, quads)
+
+def warp(image, M, size):
+    return _cache.warp(image, M, size) if ALIGN_CACHE else cv2.warpPerspective(image, M, size)
@@ -0,0 +1,229 @@
+import os
+import json
+import cv2
+import numpy as np
+
+# === CONFIGURATION ===
+# Backend used for both detectors: "torch" (ultralytics eager), "onnxruntime", "onnxruntime-int8"
+# or "openvino". Exported graphs are produced by `python export_models.py`, INT8 graphs by
+# `python quantize_models.py`.
+INFERENCE_ENGINE = os.environ.get("MCQ_INFERENCE_ENGINE", "torch").lower()
+ENGINES = ("torch", "onnxruntime", "onnxruntime-int8", "openvino")
+
+IOU_THRESHOLD = 0.7     # ultralytics predict() default
+MAX_DET = 300
+LETTERBOX_COLOR = 114
+
+
+# === EXPORTED FILE LAYOUT ===
+# models/foo.pt -> models/foo.onnx, models/foo.int8.onnx, models/foo_openvino_model/foo.xml,
+#                  models/foo.export.json
+def onnx_path(pt_path):
+    return os.path.splitext(pt_path)[0] + ".onnx"
+
+def int8_onnx_path(pt_path):
+    return os.path.splitext(pt_path)[0] + ".int8.onnx"
+
+def openvino_path(pt_path):
+    stem = os.path.splitext(os.path.basename(pt_path))[0]
+    return os.path.join(os.path.dirname(pt_path), f"{stem}_openvino_model", f"{stem}.xml")
+
+def metadata_path(pt_path):
+    return os.path.splitext(pt_path)[0] + ".export.json"
+
+def load_metadata(pt_path):
+    path = metadata_path(pt_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Export metadata not found: {path} (run export_models.py first)")
+    with open(path) as f:
+        meta = json.load(f)
+    meta["names"] = {int(k): v for k, v in meta["names"].items()}
+    return meta
+
+
+# === PRE/POST-PROCESSING (same maths as ultralytics, in NumPy) ===
+def letterbox(image, size):
+    h, w = image.shape[:2]
+    new_h, new_w = size
+    gain = min(new_h / h, new_w / w)
+    unpad_w, unpad_h = int(round(w * gain)), int(round(h * gain))
+    pad_x, pad_y = (new_w - unpad_w) / 2, (new_h - unpad_h) / 2
+
+    if (unpad_w, unpad_h) != (w, h):
+        image = cv2.resize(image, (unpad_w, unpad_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT,
+                               value=(LETTERBOX_COLOR,) * 3)
+    return image, gain, (left, top)
+
+def to_blob(images, size):
+    # BGR HWC uint8 -> RGB NCHW float32 in [0, 1]
+    blob = np.empty((len(images), 3, size[0], size[1]), dtype=np.float32)
+    transforms = []
+    for i, image in enumerate(images):
+        boxed, gain, pad = letterbox(image, size)
+        blob[i] = boxed[:, :, ::-1].transpose(2, 0, 1) * (1.0 / 255.0)
+        transforms.append((gain, pad, image.shape[:2]))
+    return blob, transforms
+
+def nms(boxes, scores, iou_threshold):
+    # Vectorised greedy NMS over xyxy boxes, returns kept indices sorted by score
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def batched_nms(boxes, scores, classes, iou_threshold):
+    # Per-class NMS in one pass by offsetting each class into its own coordinate range
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = classes[:, None].astype(np.float32) * (boxes.max() + 1)
+    return nms(boxes + offsets, scores, iou_threshold)
+
+def postprocess(output, transform, conf_threshold, iou_threshold=IOU_THRESHOLD, max_det=MAX_DET):
+    # output: (4 + num_classes, num_anchors) raw YOLOv8 head, boxes as cx, cy, w, h
+    pred = output.T
+    scores_all = pred[:, 4:]
+    classes = scores_all.argmax(1)
+    scores = scores_all[np.arange(len(pred)), classes]
+    mask = scores >= conf_threshold
+    pred, scores, classes = pred[mask], scores[mask], classes[mask]
+
+    cx, cy, w, h = pred[:, 0], pred[:, 1], pred[:, 2], pred[:, 3]
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+    keep = batched_nms(boxes, scores, classes, iou_threshold)[:max_det]
+    boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+    # Undo the letterbox back to source-image pixels
+    gain, (pad_x, pad_y), (src_h, src_w) = transform
+    boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - pad_x) / gain).clip(0, src_w)
+    boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - pad_y) / gain).clip(0, src_h)
+
+    return boxes.astype(np.float32), scores.astype(np.float32), classes.astype(np.float32)
+
+
+# === ENGINES ===
+# Every engine exposes .names and .predict(images, conf) -> [(xyxy, conf, cls), ...]
+# with one tuple of NumPy arrays per input image, in source-image pixel coordinates.
+# `threads` caps intra-op threads for the exported engines; torch takes its budget from the
+# calling thread instead (see stage_executor.py).
+class TorchEngine:
+    name = "torch"
+
+    def __init__(self, pt_path, threads=None):
+        from ultralytics import YOLO
+        self.model = YOLO(pt_path)
+        self.names = self.model.names
+
+    def predict(self, images, conf, imgsz=None):
+        kwargs = {"conf": conf, "verbose": False}
+        if imgsz is not None:
+            kwargs["imgsz"] = imgsz
+        results = self.model.predict(list(images), **kwargs)
+        return [(r.boxes.xyxy.cpu().numpy(), r.boxes.conf.cpu().numpy(), r.boxes.cls.cpu().numpy())
+                for r in results]
+
+
+class _ExportedEngine:
+    # Fixed-shape graph: input is (batch, 3, H, W); batches are chunked and padded to fit
+    def __init__(self, pt_path):
+        meta = load_metadata(pt_path)
+        self.names = meta["names"]
+        self.imgsz = tuple(meta["imgsz"])
+        self.batch = int(meta.get("batch", 1))
+        self._warned = set()
+
+    def _check_imgsz(self, imgsz):
+        # The graph only runs at its exported size; other sizes are letterboxed to it, which
+        # changes the object scale the caller asked for
+        if imgsz is None:
+            return
+        requested = (imgsz, imgsz) if isinstance(imgsz, int) else tuple(imgsz)
+        if requested != self.imgsz and requested not in self._warned:
+            self._warned.add(requested)
+            print(f"⚠️ {self.name} graph was exported at {self.imgsz[0]}x{self.imgsz[1]}, "
+                  f"running imgsz {requested[0]}x{requested[1]} at that size instead "
+                  f"(re-export with export_models.py --imgsz {requested[0]} {requested[1]})")
+
+    def _infer(self, blob):
+        raise NotImplementedError
+
+    def predict(self, images, conf, imgsz=None):
+        # imgsz is baked into the graph at export time (export_models.py --imgsz H W)
+        self._check_imgsz(imgsz)
+        images = list(images)
+        outputs = []
+        for start in range(0, len(images), self.batch):
+            chunk = images[start:start + self.batch]
+            blob, transforms = to_blob(chunk, self.imgsz)
+            if len(chunk) < self.batch:
+                pad = np.zeros((self.batch - len(chunk),) + blob.shape[1:], dtype=blob.dtype)
+                blob = np.concatenate([blob, pad])
+            raw = self._infer(blob)
+            outputs.extend(postprocess(raw[i], t, conf) for i, t in enumerate(transforms))
+        return outputs
+
+
+class OnnxRuntimeEngine(_ExportedEngine):
+    name = "onnxruntime"
+
+    def __init__(self, pt_path, threads=None, int8=False):
+        super().__init__(pt_path)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        path = int8_onnx_path(pt_path) if int8 else onnx_path(pt_path)
+        if int8:
+            self.name = "onnxruntime-int8"
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _infer(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+
+class OpenVinoEngine(_ExportedEngine):
+    name = "openvino"
+
+    def __init__(self, pt_path, threads=None):
+        super().__init__(pt_path)
+        import openvino as ov
+        core = ov.Core()
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if threads:
+            config["INFERENCE_NUM_THREADS"] = threads
+        self.compiled = core.compile_model(openvino_path(pt_path), "CPU", config)
+        self.output = self.compiled.output(0)
+
+    def _infer(self, blob):
+        return self.compiled(blob)[self.output]
+
+
+_ENGINE_CLASSES = {
+    "torch": TorchEngine,
+    "onnxruntime": OnnxRuntimeEngine,
+    "onnxruntime-int8": lambda pt_path, threads=None: OnnxRuntimeEngine(pt_path, threads, int8=True),
+    "openvino": OpenVinoEngine,
+}
+
+def load_engine(pt_path, engine=None, threads=None):
+    engine = (engine or INFERENCE_ENGINE).lower()
+    if engine not in _ENGINE_CLASSES:
+        raise ValueError(f"Unknown inference engine '{engine}', expected one of {ENGINES}")
+    return _ENGINE_CLASSES[engine](pt_path, threads=threads)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import traceback
+
+from starlette.concurrency import run_in_threadpool
+
+# === CONFIGURATION ===
+JOBS_DB_PATH = os.environ.get("MCQ_JOBS_DB", "jobs.sqlite3")
+# Sheets graded at the same time across all jobs
+JOB_CONCURRENCY = int(os.environ.get("MCQ_JOB_CONCURRENCY", "2"))
+# Finished jobs (and their results) are deleted this long after they finish
+JOB_RETENTION_HOURS = float(os.environ.get("MCQ_JOB_RETENTION_HOURS", "24"))
+PURGE_INTERVAL_S = 600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    reader TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS sheets (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    data BLOB,
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+"""
+
+
+# === SQLITE STORE ===
+# One job per upload, one row per sheet. A sheet keeps its image bytes until it is graded,
+# so queued and half-done jobs are picked up again after a restart.
+class JobStore:
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def create(self, reader, sheets):
+        # sheets: iterable of (filename, image_bytes or None, ready_result or None)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(
+                    "INSERT INTO jobs (id, status, reader, total, created_at) VALUES (?, 'queued', ?, 0, ?)",
+                    (job_id, reader, time.time()))
+                total = 0
+                for idx, (filename, data, result) in enumerate(sheets):
+                    self._db.execute(
+                        "INSERT INTO sheets (job_id, idx, filename, data, result) VALUES (?, ?, ?, ?, ?)",
+                        (job_id, idx, filename, data, None if result is None else json.dumps(result)))
+                    total += 1
+                self._db.execute("UPDATE jobs SET total = ? WHERE id = ?", (total, job_id))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        # Sheets rejected up front already carry their result
+        self._refresh(job_id)
+        return job_id
+
+    def pending_sheets(self, job_id=None):
+        # [(job_id, idx)] still to be graded, oldest job first
+        query = ("SELECT s.job_id, s.idx FROM sheets s JOIN jobs j ON j.id = s.job_id "
+                 "WHERE s.result IS NULL {} ORDER BY j.created_at, s.idx")
+        with self._lock:
+            if job_id is None:
+                return self._db.execute(query.format("")).fetchall()
+            return self._db.execute(query.format("AND s.job_id = ?"), (job_id,)).fetchall()
+
+    def load_sheet(self, job_id, idx):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT s.filename, s.data, j.reader FROM sheets s JOIN jobs j ON j.id = s.job_id "
+                "WHERE s.job_id = ? AND s.idx = ? AND s.result IS NULL", (job_id, idx)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (job_id,))
+        return row
+
+    def save_result(self, job_id, idx, result):
+        with self._lock:
+            self._db.execute(
+                "UPDATE sheets SET result = ?, data = NULL WHERE job_id = ? AND idx = ?",
+                (json.dumps(result), job_id, idx))
+        self._refresh(job_id)
+
+    def _refresh(self, job_id):
+        # Recount progress; a job is done once every sheet has a result, failed if none graded
+        with self._lock:
+            completed, failed = self._db.execute(
+                "SELECT COUNT(result), COALESCE(SUM(json_extract(result, '$.error') IS NOT NULL), 0) "
+                "FROM sheets WHERE job_id = ?", (job_id,)).fetchone()
+            self._db.execute(
+                "UPDATE jobs SET completed = ?, failed = ?, "
+                "status = CASE WHEN ? < total THEN status WHEN ? = total AND total > 0 THEN 'failed' ELSE 'done' END, "
+                "finished_at = CASE WHEN ? < total THEN NULL ELSE ? END WHERE id = ?",
+                (completed, failed, completed, failed, completed, time.time(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._db.execute(
+                "SELECT status, reader, total, completed, failed, created_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+            if job is None:
+                return None
+            results = self._db.execute(
+                "SELECT result FROM sheets WHERE job_id = ? AND result IS NOT NULL ORDER BY idx",
+                (job_id,)).fetchall()
+        status, reader, total, completed, failed, created_at, finished_at = job
+        return {
+            "job_id": job_id, "status": status, "reader": reader,
+            "total": total, "completed": completed, "failed": failed,
+            "created_at": created_at, "finished_at": finished_at,
+            "results": [json.loads(r) for (r,) in results],
+        }
+
+    def purge(self, retention_s):
+        cutoff = time.time() - retention_s
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM sheets WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)", (cutoff,))
+            removed = self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,)).rowcount
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# === BACKGROUND RUNNER ===
+# A fixed number of asyncio workers take (job_id, idx) sheets off one queue and hand them to
+# `grade(filename, image_bytes, reader)`, which returns the sheet's result line.
+class JobRunner:
+    def __init__(self, store, grade, concurrency=JOB_CONCURRENCY, retention_hours=JOB_RETENTION_HOURS):
+        self.store = store
+        self.grade = grade
+        self.concurrency = max(1, concurrency)
+        self.retention_s = retention_hours * 3600
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    async def start(self):
+        # Resume whatever was queued or in flight when the server last stopped
+        pending = await run_in_threadpool(self.store.pending_sheets)
+        for sheet in pending:
+            self._queue.put_nowait(sheet)
+        if pending:
+            print(f"🔁 Resuming {len(pending)} queued sheet(s) from {self.store.path}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._purge_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await run_in_threadpool(self.store.close)
+
+    async def submit(self, reader, sheets):
+        job_id = await run_in_threadpool(self.store.create, reader, sheets)
+        for sheet in await run_in_threadpool(self.store.pending_sheets, job_id):
+            self._queue.put_nowait(sheet)
+        return job_id
+
+    async def _worker(self):
+        while True:
+            job_id, idx = await self._queue.get()
+            filename = None
+            try:
+                row = await run_in_threadpool(self.store.load_sheet, job_id, idx)
+                if row is None:
+                    continue    # purged, or already graded
+                filename, data, reader = row
+                result = await self.grade(filename, data, reader)
+                await run_in_threadpool(self.store.save_result, job_id, idx, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Record the failure so the job still finishes
+                print(f"❌ Job {job_id} sheet {idx} failed:", str(e))
+                traceback.print_exc()
+                await run_in_threadpool(self.store.save_result, job_id, idx, {"filename": filename, "error": str(e)})
+
+    async def _purge_loop(self):
+        while True:
+            removed = await run_in_threadpool(self.store.purge, self.retention_s)
+            if removed:
+                print(f"🧹 Removed {removed} expired job(s)")
+            await asyncio.sleep(min(PURGE_INTERVAL_S, max(self.retention_s, 1)))
@@ -1,17 +1,101 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-import shutil, os, uuid, base64, traceback
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os, json, shutil, tempfile, zipfile, traceback, threading, asyncio
 
 # Import your processing function
-from process_mcq_sheet import process_sheet
+from process_mcq_sheet import (
+    process_image, warm_up_models, decode_image, prepare_sheet, build_results, map_detections,
+    ImageDecodeError, BUBBLE_READERS, DEFAULT_READER,
+)
+from batch_scheduler import BatchScheduler
+from worker_pool import GradingWorkerPool, NUM_WORKERS
+from streaming_upload import read_base64_json, PayloadTooLarge, MAX_UPLOAD_BYTES
+from jobs import JobStore, JobRunner
+from result_cache import ResultCache
+from admission import AdmissionController, AdmissionMiddleware
+import metrics
+import debug_artifacts
+from debug_artifacts import new_request_id, artifacts_for
+from alignment_quality import AlignmentRejected
+from answer_keys import AnswerKeyRegistry, InvalidAnswerKey, UnknownAnswerKey, score_results, score_many
+import model_registry
+import stage_executor
+
+# Grading runs in a pool of worker processes when MCQ_WORKERS > 0; otherwise in this process,
+# micro-batching inference across concurrent requests (set MCQ_BATCHING=0 to grade one sheet at a time)
+worker_pool = GradingWorkerPool(NUM_WORKERS) if NUM_WORKERS > 0 else None
+BATCHING_ENABLED = worker_pool is None and os.environ.get("MCQ_BATCHING", "1") == "1"
+scheduler = BatchScheduler() if BATCHING_ENABLED else None
+job_runner = None       # background /jobs grading, started with the app
+result_cache = ResultCache()
+admission = AdmissionController()
+# Answer keys per course code and version (POST /templates); the built-in CORRECT_ANSWERS
+# key applies when a request names no course
+answer_keys = AnswerKeyRegistry()
+
+# CPU-bound grading (decode, alignment, inference) runs on its own bounded thread pool, so the
+# event loop and Starlette's shared threadpool stay free for health checks and uploads
+GRADING_THREADS = int(os.environ.get("MCQ_GRADING_THREADS", str(max(2, (os.cpu_count() or 2) // 2))))
+grading_executor = ThreadPoolExecutor(GRADING_THREADS, thread_name_prefix="grading")
+# A request still grading after this long gets 504 and its remaining work is dropped
+REQUEST_TIMEOUT_S = float(os.environ.get("MCQ_REQUEST_TIMEOUT_S", "60"))
+DISCONNECT_POLL_S = 0.25
+
+# Sheets of one /grade_batch upload that are graded at the same time
+BATCH_CONCURRENCY = int(os.environ.get("MCQ_BATCH_CONCURRENCY", "8"))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
-# Ensure debug folder exists
-os.makedirs("debug_outputs", exist_ok=True)
 
-app = FastAPI()
+def _load_and_warm_up():
+    try:
+        warm_up_models()
+        model_registry.mark_ready()
+        print("✅ Models loaded and warmed up:", model_registry.loaded_models())
+    except Exception as e:
+        print("❌ Model warm-up failed:", str(e))
+        traceback.print_exc()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if worker_pool is not None:
+        # Each worker loads and warms up its own models
+        worker_pool.start()
+    else:
+        # Warm up in the background so /ping answers while models load; /ready reports when done
+        threading.Thread(target=_load_and_warm_up, name="model-warmup", daemon=True).start()
+    if scheduler is not None:
+        scheduler.start()
+    global job_runner
+    job_runner = JobRunner(JobStore(), _grade_job_sheet)
+    await job_runner.start()
+    yield
+    await job_runner.stop()
+    answer_keys.close()
+    if scheduler is not None:
+        scheduler.stop()
+    if worker_pool is not None:
+        await run_in_threadpool(worker_pool.shutdown)
+    grading_executor.shutdown(wait=False, cancel_futures=True)
+    debug_artifacts.shutdown()
+    stage_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Bounded queue depth + per-client cap in front of grading; over the limit gets 429 + Retry-After.
+# A /grade_batch upload counts as one request (it grades MCQ_BATCH_CONCURRENCY sheets at a time);
+# /jobs is not limited, its sheets wait in SQLite for the job workers
+app.add_middleware(AdmissionMiddleware, controller=admission, paths=("/grade", "/grade_base64", "/grade_batch"))
+# Outside admission control, so 429s show up in the request metrics
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -21,26 +105,195 @@ app.add_middleware(
 )
 
 
+def check_reader(reader):
+    if reader not in BUBBLE_READERS:
+        raise HTTPException(status_code=400, detail=f"Unknown reader '{reader}', expected one of {list(BUBBLE_READERS)}.")
+
+
+async def resolve_key(course_code, key_version=None):
+    # None when no course is named; looked up before grading so a bad course fails fast
+    if not course_code:
+        return None
+    try:
+        return await run_in_threadpool(answer_keys.get, course_code, key_version)
+    except UnknownAnswerKey as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+async def grade_sheet(image_bytes, reader=DEFAULT_READER, debug=None):
+    # Re-uploads of a photo already graded under the same answer key and config skip the pipeline
+    # (hashing a multi-MB photo takes milliseconds, so it runs off the event loop).
+    # A request that wants debug artifacts always runs the pipeline.
+    key = await run_in_threadpool(result_cache.key, image_bytes, reader)
+    if debug is None:
+        results = result_cache.get_memory(key)
+        if results is None and result_cache.cache_dir:
+            results = await run_in_threadpool(result_cache.get_disk, key)
+        if results is not None:
+            return results
+
+    results = await run_pipeline(image_bytes, reader, debug)
+    if result_cache.cache_dir:
+        await run_in_threadpool(result_cache.put, key, results)
+    else:
+        result_cache.put(key, results)
+    return results
+
+
+async def run_grading(fn, *args, **kwargs):
+    # Cancelling the awaiting task drops the call if it hasn't started yet
+    return await asyncio.get_running_loop().run_in_executor(grading_executor, partial(fn, *args, **kwargs))
+
+
+def _decode_and_submit(image_bytes, reader, debug):
+    # Runs on the grading pool: copying the decoded pixels into shared memory takes as long
+    # as a decode, so neither happens on the event loop
+    return worker_pool.submit(decode_image(image_bytes), reader, debug)
+
+
+async def run_pipeline(image_bytes, reader=DEFAULT_READER, debug=None):
+    # Uploads are decoded in memory with cv2.imdecode; nothing touches the disk
+    if worker_pool is not None:
+        # The pixels reach the worker through shared memory
+        return await asyncio.wrap_future(await run_grading(_decode_and_submit, image_bytes, reader, debug))
+
+    image = await run_grading(decode_image, image_bytes)
+
+    if reader != "yolo" or scheduler is None:
+        # Fill-ratio / cascade reading doesn't go through the full-sheet batch
+        return await run_grading(process_image, image, reader=reader, debug=debug)
+
+    # Alignment runs on the grading pool; both model calls are batched with other requests
+    aligned, reg_zone = await run_grading(prepare_sheet, image, debug, reader)
+    reg_number, detections = await asyncio.wrap_future(scheduler.submit(aligned, reg_zone))
+    return build_results(reg_number, map_detections(detections))
+
+
+# === REQUEST LIFETIME ===
+class ClientDisconnected(Exception):
+    pass
+
+
+async def _wait_for_disconnect(request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_S)
+
+
+async def grade_request(request, image_bytes, reader, debug=None):
+    # grade_sheet under the per-request timeout; abandoned as soon as the client goes away
+    grading = asyncio.ensure_future(grade_sheet(image_bytes, reader, debug))
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({grading, watcher}, timeout=REQUEST_TIMEOUT_S,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if grading in done:
+            return grading.result()
+        if watcher in done:
+            raise ClientDisconnected()
+        raise asyncio.TimeoutError()
+    finally:
+        watcher.cancel()
+        grading.cancel()
+
+
+def timeout_response():
+    metrics.ERRORS.inc("timeout")
+    return JSONResponse(status_code=504, content={"error": f"Grading took longer than {REQUEST_TIMEOUT_S:g}s.", "answers": []})
+
+
+def alignment_response(e):
+    # Rejected before any model ran; "alignment" names the failed corner so the app can ask for a retake
+    return JSONResponse(status_code=422, content={"error": str(e), "answers": [], "alignment": e.report})
+
+
+def disconnected_response():
+    metrics.ERRORS.inc("disconnect")
+    print("🔌 Client disconnected, grading abandoned")
+    return Response(status_code=499)
+
+
 @app.get("/ping")
 async def ping():
     return {"message": "pong"}
 
 
+@app.get("/ready")
+async def ready():
+    if worker_pool is not None:
+        if not worker_pool.is_ready():
+            failed = worker_pool.failed_workers()
+            if failed:
+                return JSONResponse(status_code=503, content={"ready": False, "failed_workers": failed})
+            return JSONResponse(status_code=503, content={"ready": False})
+        return {"ready": True, "workers": worker_pool.num_workers}
+    if not model_registry.is_ready():
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True, "models": model_registry.loaded_models()}
+
+
+def _collect_service_metrics():
+    cache = result_cache.stats()
+    gate = admission.stats()
+    return [
+        ("mcq_cache_lookups_total", "counter", "Result cache lookups by outcome",
+         [({"result": r}, cache[k]) for r, k in (("memory_hit", "memory_hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))]),
+        ("mcq_cache_hit_ratio", "gauge", "Share of result cache lookups answered from cache", [({}, cache["hit_ratio"])]),
+        ("mcq_admitted_in_flight", "gauge", "Grading requests currently admitted", [({}, gate["in_flight"])]),
+        ("mcq_admission_rejected_total", "counter", "Grading requests rejected with 429",
+         [({"reason": r}, n) for r, n in gate["rejected"].items()]),
+        ("mcq_service_rate", "gauge", "Grading requests completed per second over the last minute", [({}, gate["service_rate"])]),
+    ]
+
+metrics.add_collector(_collect_service_metrics)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return admission.stats()
+
+
 @app.post("/grade")
-async def grade_mcq(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith((".jpg", ".jpeg", ".png")):
+async def grade_mcq(request: Request, response: Response, file: UploadFile = File(...),
+                    reader: str = Form(DEFAULT_READER), debug: bool = Form(False),
+                    course_code: Optional[str] = Form(None), key_version: Optional[int] = Form(None)):
+    if not file.filename.lower().endswith(IMAGE_EXTENSIONS):
         raise HTTPException(status_code=400, detail="Only JPG, JPEG, or PNG files are accepted.")
+    check_reader(reader)
+    key = await resolve_key(course_code, key_version)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return JSONResponse(status_code=413, content={"error": f"Image exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit.", "answers": []})
 
-    temp_path = f"temp_{uuid.uuid4().hex}_{file.filename}"
     try:
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        image_bytes = await file.read()
+
+        # debug=true (or MCQ_DEBUG_SAMPLE_RATE) writes debug_outputs/<request id>_*.jpg
+        request_id = new_request_id(request.headers.get("x-request-id"))
+        response.headers["X-Request-ID"] = request_id
 
         # Process the uploaded sheet
-        results = process_sheet(temp_path)
+        results = await grade_request(request, image_bytes, reader, artifacts_for(request_id, debug))
 
-        return results
+        # Scored against the course's key from the marked answers; the cached inference result is key-independent
+        return score_results(results, key) if key else results
 
+    except ImageDecodeError as e:
+        return JSONResponse(status_code=400, content={"error": str(e), "answers": []})
+    except AlignmentRejected as e:
+        return alignment_response(e)
+    except asyncio.TimeoutError:
+        return timeout_response()
+    except ClientDisconnected:
+        return disconnected_response()
     except Exception as e:
         # Print full error in console for debugging
         print("❌ Backend error:", str(e))
@@ -50,35 +303,56 @@ async def grade_mcq(file: UploadFile = File(...)):
             status_code=500,
             content={"error": str(e), "answers": []}
         )
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
 
 
 class Base64Image(BaseModel):
     filename: str
     content: str
+    reader: str = DEFAULT_READER
+    debug: bool = False
+    course_code: Optional[str] = None
+    key_version: Optional[int] = None
 
 
-@app.post("/grade_base64")
-async def grade_base64_image(data: Base64Image):
-    temp_path = None
+@app.post("/grade_base64", openapi_extra={"requestBody": {
+    "required": True, "content": {"application/json": {"schema": Base64Image.model_json_schema()}}}})
+async def grade_base64_image(request: Request, response: Response):
+    # The body is streamed: base64 "content" is decoded chunk by chunk into one preallocated
+    # buffer, so the request never holds the base64 text or a second decoded copy
     try:
-        base64_data = data.content
-        if base64_data.startswith("data:image"):
-            base64_data = base64_data.split(";base64,")[-1]
-
-        image_bytes = base64.b64decode(base64_data)
-        temp_path = f"temp_{uuid.uuid4().hex}_{data.filename}"
-
-        with open(temp_path, "wb") as f:
-            f.write(image_bytes)
+        content_length = request.headers.get("content-length")
+        fields, image_bytes = await read_base64_json(
+            request.stream(), int(content_length) if content_length else None)
+        # The remaining fields get the model's checks; "content" was already decoded
+        payload = Base64Image.model_validate({**fields, "content": ""})
+    except PayloadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e), "answers": []})
+    except ValidationError as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid request body: {e}", "answers": []})
+    except ValueError as e:
+        # InvalidPayload, or a malformed Content-Length header
+        return JSONResponse(status_code=400, content={"error": str(e), "answers": []})
 
+    reader = payload.reader
+    check_reader(reader)
+    key = await resolve_key(payload.course_code, payload.key_version)
+    request_id = new_request_id(request.headers.get("x-request-id"))
+    response.headers["X-Request-ID"] = request_id
+    try:
         # Process the uploaded sheet
-        results = process_sheet(temp_path)
+        debug = artifacts_for(request_id, payload.debug)
+        results = await grade_request(request, image_bytes, reader, debug)
 
-        return results
+        return score_results(results, key) if key else results
 
+    except ImageDecodeError as e:
+        return JSONResponse(status_code=400, content={"error": str(e), "answers": []})
+    except AlignmentRejected as e:
+        return alignment_response(e)
+    except asyncio.TimeoutError:
+        return timeout_response()
+    except ClientDisconnected:
+        return disconnected_response()
     except Exception as e:
         print("❌ Backend error:", str(e))
         traceback.print_exc()
@@ -87,6 +361,193 @@ async def grade_base64_image(data: Base64Image):
             status_code=500,
             content={"error": str(e), "answers": []}
         )
+
+
+# === BATCH GRADING ===
+def _spool_upload(upload):
+    # FastAPI may close the form's files once the handler returns, before the stream is
+    # consumed, so the stream works on its own copy (spilled to disk past 1 MB)
+    copy = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    upload.file.seek(0)
+    shutil.copyfileobj(upload.file, copy)
+    copy.seek(0)
+    return upload.filename or "", copy
+
+
+def _spooled_size(fileobj):
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(0)
+    return size
+
+
+def _batch_sources(spooled):
+    # (name, loader) for every file in the upload, loader None for anything rejected (one result
+    # line per input); zip members are only read when graded
+    for name, fileobj in spooled:
+        if name.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(fileobj)
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if not info.filename.lower().endswith(IMAGE_EXTENSIONS) or info.file_size > MAX_UPLOAD_BYTES:
+                    yield info.filename, None
+                    continue
+                yield info.filename, (lambda info=info, archive=archive: archive.read(info))
+        elif name.lower().endswith(IMAGE_EXTENSIONS) and _spooled_size(fileobj) <= MAX_UPLOAD_BYTES:
+            yield name, fileobj.read
+        else:
+            yield name, None
+
+
+def _result_line(name, error=None):
+    return {"filename": name, "reg_number": None, "score": None, "total": None, "answers": [], "error": error}
+
+_REJECTED = "Not a JPG/JPEG/PNG image, or larger than the upload limit."
+
+
+async def _grade_batch_item(name, load, reader, key=None):
+    if load is None:
+        return _result_line(name, _REJECTED)
+    line = _result_line(name)
+    try:
+        image_bytes = await run_in_threadpool(load)
+        debug = artifacts_for(new_request_id())      # sampled only
+        results = await asyncio.wait_for(grade_sheet(image_bytes, reader, debug), REQUEST_TIMEOUT_S)
+        if key is not None:
+            results = score_results(results, key)
+            line.update(course_code=key.course_code, key_version=key.version)
+        line.update(reg_number=results["reg_number"], score=results["score"],
+                    total=results["total"], answers=results["answers"])
+    except AlignmentRejected as e:
+        line.update(error=str(e), alignment=e.report)
+    except asyncio.TimeoutError:
+        metrics.ERRORS.inc("timeout")
+        line["error"] = f"Grading took longer than {REQUEST_TIMEOUT_S:g}s."
+    except Exception as e:
+        print(f"❌ Batch item {name} failed:", str(e))
+        line["error"] = str(e)
+    return line
+
+
+async def _stream_batch(spooled, reader, key=None):
+    # One NDJSON line per sheet, in completion order, as soon as each sheet is graded
+    finished = asyncio.Queue()
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(name, load):
+        async with slots:
+            await finished.put(await _grade_batch_item(name, load, reader, key))
+
+    tasks = [asyncio.create_task(run(name, load)) for name, load in _batch_sources(spooled)]
+    try:
+        for _ in tasks:
+            yield json.dumps(await finished.get()) + "\n"
     finally:
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
+        # Client went away or the stream finished: drop whatever is still queued
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for _, fileobj in spooled:
+            fileobj.close()
+
+
+async def _spool_files(files):
+    # Copies the uploads and checks zip archives; returns (spooled, error_response)
+    spooled = [await run_in_threadpool(_spool_upload, upload) for upload in files]
+    try:
+        # Open zip archives up front so a corrupt archive fails the request, not a sheet
+        for name, fileobj in spooled:
+            if name.lower().endswith(".zip"):
+                zipfile.ZipFile(fileobj).close()
+                fileobj.seek(0)
+    except zipfile.BadZipFile as e:
+        for _, fileobj in spooled:
+            fileobj.close()
+        return None, JSONResponse(status_code=400, content={"error": f"Invalid zip archive: {e}"})
+    return spooled, None
+
+
+@app.post("/grade_batch")
+async def grade_batch(files: List[UploadFile] = File(...), reader: str = Form(DEFAULT_READER),
+                      course_code: Optional[str] = Form(None), key_version: Optional[int] = Form(None)):
+    # Accepts any mix of images and .zip archives of images; the response is NDJSON with one
+    # {"filename", "reg_number", "score", "total", "answers", "error"} line per sheet
+    check_reader(reader)
+    key = await resolve_key(course_code, key_version)
+    spooled, error = await _spool_files(files)
+    if error is not None:
+        return error
+    return StreamingResponse(_stream_batch(spooled, reader, key), media_type="application/x-ndjson")
+
+
+# === GRADING JOBS ===
+async def _grade_job_sheet(filename, image_bytes, reader):
+    return await _grade_batch_item(filename, lambda: image_bytes, reader)
+
+
+def _job_sheets(spooled):
+    # (filename, image_bytes, ready_result) rows for the job store; rejected files are
+    # stored with their error line and never graded
+    try:
+        for name, load in _batch_sources(spooled):
+            if load is None:
+                yield name, None, _result_line(name, _REJECTED)
+            else:
+                yield name, load(), None
+    finally:
+        for _, fileobj in spooled:
+            fileobj.close()
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(files: List[UploadFile] = File(...), reader: str = Form(DEFAULT_READER)):
+    # Same uploads as /grade_batch, but answers at once with a job ID; poll GET /jobs/{job_id}
+    check_reader(reader)
+    spooled, error = await _spool_files(files)
+    if error is not None:
+        return error
+    job_id = await job_runner.submit(reader, _job_sheets(spooled))
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, course_code: Optional[str] = None, key_version: Optional[int] = None):
+    # status is queued, running, done, or failed (no sheet could be graded);
+    # results holds the lines of the sheets finished so far, in upload order.
+    # With course_code the stored marks are re-scored against that key - no inference reruns.
+    key = await resolve_key(course_code, key_version)
+    job = await run_in_threadpool(job_runner.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job.")
+    if key is not None:
+        job["results"] = score_many(job["results"], key)
+    return job
+
+
+# === ANSWER KEYS ===
+class AnswerKeyIn(BaseModel):
+    course_code: str
+    answers: List[str]
+
+
+@app.post("/templates", status_code=201)
+async def create_answer_key(body: AnswerKeyIn):
+    # Saves the next version of the course's key: {"course_code": "CSC101", "answers": ["A", "C", ...]}
+    try:
+        key = await run_in_threadpool(answer_keys.add, body.course_code, body.answers)
+    except InvalidAnswerKey as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"course_code": key.course_code, "version": key.version, "total": key.total}
+
+
+@app.get("/templates")
+async def list_answer_keys():
+    return await run_in_threadpool(answer_keys.courses)
+
+
+@app.get("/templates/{course_code}")
+async def get_answer_keys(course_code: str):
+    versions = await run_in_threadpool(answer_keys.versions, course_code)
+    if not versions:
+        raise HTTPException(status_code=404, detail=f"No answer key for course '{course_code}'.")
+    return {"course_code": course_code, "versions": versions}
@@ -0,0 +1,97 @@
+import os
+import cv2
+import numpy as np
+
+# === CONFIGURATION ===
+# "coarse" finds the four corner markers on a downscaled copy, then re-detects each one at full
+# resolution inside a small window around its coarse position. "full" is the whole-image search.
+MARKER_SEARCH = os.environ.get("MCQ_MARKER_SEARCH", "coarse").lower()
+COARSE_LONG_SIDE = 1024             # px; long side of the coarse search image
+MARKER_MIN_AREA, MARKER_MAX_AREA = 500, 20000     # full-resolution px^2
+MARKER_MAX_ASPECT = 1.2
+MARKER_MIN_FILL = 0.85
+WINDOW_MIN_HALF = 48                # px; smallest full-resolution refine window (half side)
+WINDOW_MARKER_SIDES = 3             # refine window half side, in marker sides
+
+
+def marker_mask(gray):
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blur, 100, 255, cv2.THRESH_BINARY_INV)
+    return thresh
+
+def marker_candidates(gray, min_area=MARKER_MIN_AREA, max_area=MARKER_MAX_AREA):
+    # Solid, square dark blobs as [(cx, cy, area, box)], box being the 4x2 min-area rectangle.
+    # Centres are contour centroids from the moments, so they are sub-pixel rather than rounded
+    # box centres.
+    contours, _ = cv2.findContours(marker_mask(gray), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    found = []
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        if not min_area < area < max_area:
+            continue
+        rect = cv2.minAreaRect(cnt)
+        w, h = rect[1]
+        if w == 0 or h == 0:
+            continue
+        if max(w, h) / min(w, h) < MARKER_MAX_ASPECT and area / (w * h) > MARKER_MIN_FILL:
+            m = cv2.moments(cnt)
+            found.append((m["m10"] / m["m00"], m["m01"] / m["m00"], area, cv2.boxPoints(rect)))
+    return found
+
+def nearest_to_corners(candidates, width, height):
+    # Closest candidate to each image corner: top-left, top-right, bottom-left, bottom-right
+    corners = [(0, 0), (width, 0), (0, height), (width, height)]
+    return [min(candidates, key=lambda c: np.hypot(c[0] - cx, c[1] - cy)) for cx, cy in corners]
+
+
+# === SEARCH ===
+def locate_markers_full(gray):
+    # Whole image at full resolution; [(x, y, box)] x4 or None
+    candidates = marker_candidates(gray)
+    if len(candidates) < 4:
+        return None
+    h, w = gray.shape[:2]
+    return [(x, y, box) for x, y, _, box in nearest_to_corners(candidates, w, h)]
+
+def refine_marker(gray, x, y, half):
+    # Full-resolution re-detection inside a window around (x, y); None if no marker is there
+    h, w = gray.shape[:2]
+    x1, y1 = max(0, int(x) - half), max(0, int(y) - half)
+    x2, y2 = min(w, int(x) + half), min(h, int(y) + half)
+    found = marker_candidates(gray[y1:y2, x1:x2])
+    if not found:
+        return None
+    cx, cy, _, box = min(found, key=lambda c: np.hypot(c[0] + x1 - x, c[1] + y1 - y))
+    return cx + x1, cy + y1, box + (x1, y1)
+
+def locate_markers(gray, search=MARKER_SEARCH):
+    # [(x, y, box)] for the TL, TR, BL, BR markers, or None when fewer than four are found
+    h, w = gray.shape[:2]
+    scale = COARSE_LONG_SIDE / max(h, w)
+    if search == "full" or scale >= 1.0:
+        return locate_markers_full(gray)
+
+    # Coarse pass: same filters, area bounds scaled to the small image. Bilinear rather than
+    # INTER_AREA: ~20x cheaper at these factors, and the markers are large solid blobs.
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    candidates = marker_candidates(small, MARKER_MIN_AREA * scale ** 2, MARKER_MAX_AREA * scale ** 2)
+    if len(candidates) < 4:
+        # Markers too small to survive downscaling; don't lose sheets the full search would find
+        return locate_markers_full(gray)
+
+    markers = []
+    for cx, cy, area, box in nearest_to_corners(candidates, small.shape[1], small.shape[0]):
+        x, y = cx / scale, cy / scale
+        half = max(WINDOW_MIN_HALF, int(WINDOW_MARKER_SIDES * np.sqrt(area) / scale))
+        markers.append(refine_marker(gray, x, y, half) or (x, y, box / scale))
+    return markers
+
+def corners_without_candidates(gray):
+    # Indexes (TL, TR, BL, BR) of the image quadrants holding no marker-like blob, for failure reports
+    h, w = gray.shape[:2]
+    scale = min(1.0, COARSE_LONG_SIDE / max(h, w))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR) if scale < 1.0 else gray
+    candidates = marker_candidates(small, MARKER_MIN_AREA * scale ** 2, MARKER_MAX_AREA * scale ** 2)
+    sh, sw = small.shape[:2]
+    occupied = {(x >= sw / 2) + 2 * (y >= sh / 2) for x, y, _, _ in candidates}
+    return [corner for corner in range(4) if corner not in occupied]
@@ -15,6 +15,19 @@ import axios from "axios";
 import { BASE_URL } from "../../config";
 import * as FileSystem from 'expo-file-system';
 
+// Retry while the server is over capacity (HTTP 429), waiting as long as its Retry-After says
+const MAX_BUSY_RETRIES = 3;
+const fetchWithBackoff = async (url, options) => {
+  for (let attempt = 0; ; attempt++) {
+    const response = await fetch(url, options);
+    if (response.status !== 429 || attempt >= MAX_BUSY_RETRIES) {
+      return response;
+    }
+    const retryAfter = parseInt(response.headers.get("Retry-After"), 10) || 5;
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+  }
+};
+
 export default function GradeScreen({ route, navigation }) {
   const { template, courseCode } = route.params; // ✅ passed from TemplatesScreen
   const [image, setImage] = useState(null);
@@ -58,7 +71,7 @@ export default function GradeScreen({ route, navigation }) {
       });
 
       // Send base64 to backend
-      const response = await fetch(`${BASE_URL}/grade_base64`, {
+      const response = await fetchWithBackoff(`${BASE_URL}/grade_base64`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -71,6 +84,12 @@ export default function GradeScreen({ route, navigation }) {
       });
 
       const data = await response.json();
+
+      // 422: the sheet couldn't be aligned; nothing was graded, ask for a new photo
+      if (response.status === 422) {
+        Alert.alert("Retake photo", data.error || "The sheet's corner markers could not be found.");
+        return;
+      }
       if (!data || !data.answers) {
         throw new Error("Invalid grading response");
       }
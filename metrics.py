@@ -0,0 +1,217 @@
+import time
+import bisect
+import threading
+from functools import wraps
+
+# === CONFIGURATION ===
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DETECTION_BUCKETS = (0, 5, 10, 20, 25, 30, 35, 40, 50, 75, 100, 150)
+REG_LENGTH_BUCKETS = (0, 3, 6, 7, 8, 9, 10, 12)
+
+# Paths with their own request series; everything else is reported as "other"
+ENDPOINTS = ("/grade", "/grade_base64", "/grade_batch", "/jobs", "/ping", "/ready")
+
+_registry = {}
+_collectors = []
+_pending = None     # in grading worker processes: observations waiting to go to the API process
+_gauge_sink = None  # in grading worker processes: sends each gauge change to the API process at once
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# === METRIC TYPES ===
+# Minimal thread-safe counters/gauges/histograms rendered in the Prometheus text format.
+# Label values are passed positionally, in labelnames order.
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+        if _pending is not None:
+            _pending.append((self.name, labels, amount))
+
+    def _apply(self, labels, amount):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self._apply(labels, amount)
+        if _gauge_sink is not None:
+            _gauge_sink((self.name, labels, amount))
+
+    def _apply(self, labels, amount):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        self._apply(labels, value)
+        if _pending is not None:
+            _pending.append((self.name, labels, value))
+
+    def _apply(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = self._header()
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+# === PIPELINE METRICS ===
+STAGE_SECONDS = Histogram("mcq_stage_seconds", "Latency of one grading pipeline stage call (batched calls count once)", ["stage"])
+STAGE_IN_FLIGHT = Gauge("mcq_stage_in_flight", "Pipeline stage calls running in this process", ["stage"])
+ERRORS = Counter("mcq_errors_total", "Grading failures by type (marker, alignment, decode, model, timeout, disconnect)", ["type"])
+BUBBLE_DETECTIONS = Histogram("mcq_bubble_detections", "Bubble detections per sheet from the bubble model", buckets=DETECTION_BUCKETS)
+REG_CHARACTERS = Histogram("mcq_reg_number_characters", "Characters read per registration number", buckets=REG_LENGTH_BUCKETS)
+REQUEST_SECONDS = Histogram("mcq_request_seconds", "HTTP request latency", ["endpoint", "status"])
+REQUESTS_IN_FLIGHT = Gauge("mcq_requests_in_flight", "HTTP requests being handled", ["endpoint"])
+
+
+def timed(stage, error_type=None):
+    # Decorator: stage latency + in-flight gauge; exceptions are counted under error_type
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            STAGE_IN_FLIGHT.inc(stage)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if error_type:
+                    ERRORS.inc(error_type)
+                raise
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+                STAGE_IN_FLIGHT.dec(stage)
+        return wrapper
+    return decorate
+
+
+# === WORKER PROCESSES ===
+# Grading workers record counters/histograms locally and ship them to the API process,
+# which replays them into its own registry; /metrics then covers every process. Gauges describe
+# the present, so their changes go through gauge_sink as they happen rather than after the sheet.
+def forward_to_parent(gauge_sink=None):
+    global _pending, _gauge_sink
+    _pending = []
+    _gauge_sink = gauge_sink
+
+def take_pending():
+    global _pending
+    taken, _pending = _pending, []
+    return taken
+
+def replay(observations):
+    for name, labels, value in observations:
+        metric = _registry.get(name)
+        if metric is not None:
+            metric._apply(labels, value)
+
+
+# === EXPOSITION ===
+def add_collector(fn):
+    # fn() -> [(name, kind, help, [(labels_dict, value), ...])], called at scrape time
+    _collectors.append(fn)
+
+def render():
+    lines = []
+    for metric in list(_registry.values()):
+        lines += metric.render()
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# === ASGI MIDDLEWARE ===
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        endpoint = "/jobs" if path.startswith("/jobs") else path if path in ENDPOINTS else "other"
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(endpoint)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, str(status["code"]))
+            REQUESTS_IN_FLIGHT.dec(endpoint)
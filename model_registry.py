@@ -0,0 +1,42 @@
+import threading
+from inference_engines import load_engine, INFERENCE_ENGINE
+
+# === PROCESS-WIDE MODEL REGISTRY ===
+# Each model is loaded once per process (for the configured inference engine) and the
+# same instance is reused by every request, instead of rebuilding the graph inside
+# predict_mcq / extract_reg_number.
+_models = {}
+_threads = {}
+_lock = threading.Lock()
+_ready = threading.Event()
+
+
+def get_model(path, engine=None):
+    key = (engine or INFERENCE_ENGINE, path)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                print(f"📦 Loading model: {path} ({key[0]})")
+                model = load_engine(path, key[0], _threads.get(path))
+                _models[key] = model
+    return model
+
+
+def set_model_threads(path, threads):
+    # Intra-op thread budget for a model; only applies to models loaded afterwards
+    _threads[path] = threads
+
+
+def loaded_models():
+    return [f"{path} ({engine})" for engine, path in _models]
+
+
+# === READINESS ===
+def mark_ready():
+    _ready.set()
+
+
+def is_ready():
+    return _ready.is_set()
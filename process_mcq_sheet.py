@@ -1,16 +1,32 @@
 import cv2
 import os
 import numpy as np
-from ultralytics import YOLO
 import json
+from functools import partial
+from model_registry import get_model, set_model_threads
+from tiling import predict_tiled
+from fill_reader import read_bubbles
+from cascade_reader import read_cascade
+from marker_search import locate_markers, corners_without_candidates
+from fiducials import FIDUCIAL_MODE, MARKER_SIDE, MARKER_OUTSET, detect_fiducials
+from alignment_quality import ALIGN_CHECK, SQUARE_MARKER_SIDE, AlignmentRejected, assess
+import homography_cache
+from stage_executor import run_stages, MCQ_STAGE_THREADS, REG_STAGE_THREADS
+from metrics import timed, ERRORS, BUBBLE_DETECTIONS, REG_CHARACTERS
+import debug_artifacts
 
 # === CONFIGURATION ===
 MCQ_MODEL_PATH = "models/yolov8_bubbles_best.pt"
 REG_MODEL_PATH = "models/reg_number_model_v1.pt"
+set_model_threads(MCQ_MODEL_PATH, MCQ_STAGE_THREADS)
+set_model_threads(REG_MODEL_PATH, REG_STAGE_THREADS)
 
 # Template size after alignment
 TEMPLATE_WIDTH, TEMPLATE_HEIGHT = 2480, 3508
 
+# ArUco-marked sheets (fiducials.py) name their layout as (template id, page); only this one exists
+SHEET_LAYOUTS = {(0, 0): (TEMPLATE_WIDTH, TEMPLATE_HEIGHT)}
+
 # === FIXED ZONES (after alignment) ===
 REGION_REG_NO = (299,12,1016,219)    # Reg. No. box
 REGION_Q1_15  = (5,335,1177,3085)    # Left column (Q1–Q15)
@@ -29,6 +45,28 @@ CORRECT_ANSWERS = {
 CLASS_NAMES = ["A", "B", "C", "D", "E", "INVALID"]
 
 CONF_THRESHOLD_MCQ = 0.5
+
+# How marked answers are read: "yolo" runs the bubble detector, "fill" samples darkness at the
+# template's known bubble centres (fill_reader.py) - cheap, for clean scanner input - and
+# "cascade" uses the fill ratios first and the detector only on ambiguous questions
+BUBBLE_READERS = ("yolo", "fill", "cascade")
+DEFAULT_READER = os.environ.get("MCQ_BUBBLE_READER", "yolo").lower()
+
+# Bubble detection mode: "full" letterboxes the whole aligned sheet to the model input,
+# "roi" runs only the two answer columns, batched, at ROI_IMGSZ (h, w) so bubbles keep their size,
+# "tiled" runs overlapping native-resolution tiles (see tiling.py) for dense layouts
+MCQ_INFERENCE_MODE = os.environ.get("MCQ_INFERENCE_MODE", "full").lower()
+ANSWER_REGIONS = (REGION_Q1_15, REGION_Q16_30)
+# The bubble detector was trained on whole sheets letterboxed to 640 (the "full" mode input), so
+# ROI crops are sized to keep that scale: the tallest/widest column at 640/3508, rounded up to
+# the model stride. The cascade reader's question crops run at about the same scale.
+DETECTOR_SCALE = 640 / TEMPLATE_HEIGHT
+ROI_IMGSZ = tuple(32 * int(np.ceil(max(r[i] for r in ANSWER_REGIONS) * DETECTOR_SCALE / 32)) for i in (3, 2))
+REG_IMGSZ = (640, 640)      # reg-number model input (h, w)
+
+# "roi" warps only the regions the models read, straight from the photo, whenever the pipeline
+# needs nothing else (yolo reader + "roi" inference mode); "full" always warps the whole sheet
+WARP_MODE = os.environ.get("MCQ_WARP_MODE", "roi").lower()
 CONF_THRESHOLD_REG = 0.05
 EXPECTED_REG_LENGTH = 9
 
@@ -42,76 +80,197 @@ def crop_zone(image, region):
     return image[y:y+h, x:x+w]
 
 # === STEP 1: Marker alignment ===
-def find_markers_and_align(image):
+TEMPLATE_CORNERS = np.array([[0, 0], [TEMPLATE_WIDTH, 0], [0, TEMPLATE_HEIGHT], [TEMPLATE_WIDTH, TEMPLATE_HEIGHT]], dtype="float32")
+
+# Each returns (M, report, quads): M maps photo -> template (None if the markers weren't found),
+# report is the alignment-quality report from alignment_quality.assess and quads the markers'
+# photo-space corners (None where missing)
+def aruco_homography(gray):
+    size = (TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
+    found = detect_fiducials(gray)
+    if found is None:
+        return None, assess([None] * 4, None, gray.shape, size, MARKER_SIDE, "aruco"), None
+    layout = SHEET_LAYOUTS.get((found.template_id, found.page))
+    if layout is None:
+        print(f"⚠️ Unknown sheet layout: template {found.template_id}, page {found.page}")
+        return None, assess([None] * 4, None, gray.shape, size, MARKER_SIDE, "aruco"), None
+    M = found.homography(*layout)
+    quads = [found.points.get(corner) for corner in range(4)]
+    # Three markers are enough to read the layout and fit M, but the sheet outline can't be
+    # checked without the fourth, so the check names the corner that is missing
+    missing = [corner for corner in range(4) if quads[corner] is None]
+    return M, assess(quads, M, gray.shape, layout, MARKER_SIDE, "aruco", missing=missing, outset=MARKER_OUTSET), quads
+
+def squares_homography(gray):
+    # Plain corner squares: coarse-to-fine search by default (see marker_search.py)
+    size = (TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
+    markers = locate_markers(gray)
+    if markers is None:
+        return None, assess([None] * 4, None, gray.shape, size, SQUARE_MARKER_SIDE, "squares",
+                            missing=corners_without_candidates(gray)), None
+    M = cv2.getPerspectiveTransform(np.array([(x, y) for x, y, _ in markers], dtype="float32"), TEMPLATE_CORNERS)
+    quads = [box for _, _, box in markers]
+    return M, assess(quads, M, gray.shape, size, SQUARE_MARKER_SIDE, "squares"), quads
+
+def find_homography(image):
+    # Photo -> template transform from the sheet's fiducials. Sheets failing the alignment-quality
+    # check raise AlignmentRejected before any model runs; with MCQ_ALIGN_CHECK=0 they are graded
+    # anyway and None means "no markers, grade the unaligned image"
+    # Same rig, same place: the previous sheet's transform, if its markers haven't moved
+    # (MCQ_ALIGN_CACHE=1; only the check windows around the markers are read)
+    cached = homography_cache.lookup(image, FIDUCIAL_MODE)
+    if cached is not None:
+        return cached[0]
+
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, thresh = cv2.threshold(blur, 100, 255, cv2.THRESH_BINARY_INV)
-
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    h_img, w_img = image.shape[:2]
-
-    candidates = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if 500 < area < 20000:
-            rect = cv2.minAreaRect(cnt)
-            w, h = rect[1]
-            if w == 0 or h == 0:
-                continue
-            aspect_ratio = max(w, h) / min(w, h)
-            fill_ratio = area / (w * h)
-            if aspect_ratio < 1.2 and fill_ratio > 0.85:
-                cx, cy = np.int0(rect[0])
-                candidates.append((cx, cy, cnt))
-
-    if len(candidates) < 4:
+    M = report = quads = None
+    if FIDUCIAL_MODE in ("aruco", "auto"):
+        M, report, quads = aruco_homography(gray)
+    if M is None and FIDUCIAL_MODE in ("squares", "auto"):
+        M, report, quads = squares_homography(gray)
+
+    if M is None:
+        ERRORS.inc("marker")
+    elif not report["ok"]:
+        ERRORS.inc("alignment")
+    else:
+        homography_cache.remember(gray, FIDUCIAL_MODE, M, report, quads)
+    if not report["ok"] and ALIGN_CHECK:
+        print("⚠️ " + report["message"])
+        raise AlignmentRejected(report)
+    if M is None:
         print("⚠️ Marker detection failed — returning unaligned image")
-        return image
-
-    # Closest candidates to 4 corners
-    corners = [(0, 0), (w_img, 0), (0, h_img), (w_img, h_img)]
-    closest = [min(candidates, key=lambda c: np.hypot(c[0] - cx, c[1] - cy))[:2] for cx, cy in corners]
+    return M
 
-    src_pts = np.array(closest, dtype="float32")
-    dst_pts = np.array([[0, 0], [TEMPLATE_WIDTH, 0], [0, TEMPLATE_HEIGHT], [TEMPLATE_WIDTH, TEMPLATE_HEIGHT]], dtype="float32")
+@timed("align")
+def find_markers_and_align(image, debug=None):
+    M = find_homography(image)
+    if M is None:
+        return image
 
-    M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-    aligned = cv2.warpPerspective(image, M, (TEMPLATE_WIDTH, TEMPLATE_HEIGHT))
+    aligned = homography_cache.warp(image, M, (TEMPLATE_WIDTH, TEMPLATE_HEIGHT))
 
-    os.makedirs("debug_outputs", exist_ok=True)
-    cv2.imwrite("debug_outputs/aligned_sheet.jpg", aligned)
+    if debug is not None:
+        debug.save("aligned_sheet", aligned)
 
     return aligned
 
+# === STEP 1b: ROI-direct warping ===
+# When the pipeline only reads the template regions (reg number + the two answer columns in
+# "roi" inference mode) each region is warped straight from the photo into a buffer at the
+# resolution its model takes, instead of warping the whole sheet and cropping.
+class AlignedRegions(dict):
+    # region -> (crop, scale): the region resampled by `scale` from template pixels
+    pass
+
+def region_homography(M, region, scale):
+    # Photo -> region buffer: the marker homography followed by the region's offset and scale
+    x, y, _, _ = region
+    to_region = np.array([[scale, 0, -scale * x], [0, scale, -scale * y], [0, 0, 1]], dtype=np.float64)
+    return to_region @ M
+
+def warp_region(image, M, region, scale):
+    _, _, w, h = region
+    return homography_cache.warp(image, region_homography(M, region, scale), (round(w * scale), round(h * scale)))
+
+def region_scale(region, imgsz):
+    # Largest scale at which the region fits the model input (h, w); never upsampled
+    _, _, w, h = region
+    return min(1.0, imgsz[0] / h, imgsz[1] / w)
+
+@timed("align")
+def align_regions(image):
+    # AlignedRegions for the reg-number box and the answer columns; None if markers are missing
+    M = find_homography(image)
+    if M is None:
+        return None
+    regions = AlignedRegions()
+    for region, imgsz in ((REGION_REG_NO, REG_IMGSZ),) + tuple((r, ROI_IMGSZ) for r in ANSWER_REGIONS):
+        scale = region_scale(region, imgsz)
+        regions[region] = (warp_region(image, M, region, scale), scale)
+    return regions
+
+def regions_only(reader):
+    return WARP_MODE == "roi" and reader == "yolo" and MCQ_INFERENCE_MODE == "roi"
+
+def region_crop(sheet, region):
+    # (crop, scale) of a template region from a full aligned sheet or from AlignedRegions
+    if isinstance(sheet, AlignedRegions):
+        return sheet[region]
+    return crop_zone(sheet, region), 1.0
+
 # === STEP 2: YOLO Predictions ===
-def predict_mcq(image):
-    model = YOLO(MCQ_MODEL_PATH)
-    results = model.predict(image, conf=CONF_THRESHOLD_MCQ)[0]
-    return results.boxes.xyxy, results.boxes.conf, results.boxes.cls
+# `model` is an inference engine from model_registry (torch / onnxruntime / openvino);
+# every engine returns NumPy (xyxy, conf, cls) arrays in source-image pixels.
+def predict_mcq(image, model=None):
+    return predict_mcq_batch([image], model)[0]
 
-def extract_reg_number(region_img):
-    model = YOLO(REG_MODEL_PATH)
-    results = model.predict(region_img, conf=CONF_THRESHOLD_REG)[0]
+@timed("reg_number", "model")
+def extract_reg_number(region_img, model=None):
+    if model is None:
+        model = get_model(REG_MODEL_PATH)
+    detections = model.predict([region_img], conf=CONF_THRESHOLD_REG)[0]
+    return decode_reg_number(detections, model.names)
 
-    boxes = results.boxes.xyxy.cpu().numpy()
-    confs = results.boxes.conf.cpu().numpy()
-    classes = results.boxes.cls.cpu().numpy()
-    class_names = model.names
+def decode_reg_number(detections, class_names):
+    boxes, confs, classes = detections
 
     detections = sorted(zip(boxes, classes, confs), key=lambda x: x[2], reverse=True)[:EXPECTED_REG_LENGTH]
     detections = sorted(detections, key=lambda x: x[0][0])
 
     raw_chars = [class_names[int(cls)].strip().upper() for _, cls, _ in detections]
     corrected = [correct_character(c) for c in raw_chars]
+    REG_CHARACTERS.observe(len(corrected))
 
     return "".join(corrected)
 
+# === BATCHED PREDICTIONS (one forward pass for several sheets) ===
+@timed("predict_mcq", "model")
+def predict_mcq_batch(images, model=None):
+    if model is None:
+        model = get_model(MCQ_MODEL_PATH)
+    if MCQ_INFERENCE_MODE == "roi":
+        outputs = predict_mcq_roi_batch(images, model)
+    elif MCQ_INFERENCE_MODE == "tiled":
+        outputs = predict_tiled(images, model, CONF_THRESHOLD_MCQ)
+    else:
+        outputs = model.predict(images, conf=CONF_THRESHOLD_MCQ)
+    for boxes, _, _ in outputs:
+        BUBBLE_DETECTIONS.observe(len(boxes))
+    return outputs
+
+def predict_mcq_roi_batch(images, model):
+    # Every answer column of every sheet goes through the model in one batch
+    crops = [region_crop(image, region) for image in images for region in ANSWER_REGIONS]
+    outputs = model.predict([crop for crop, _ in crops], conf=CONF_THRESHOLD_MCQ, imgsz=ROI_IMGSZ)
+
+    per_sheet = []
+    n = len(ANSWER_REGIONS)
+    for i in range(len(images)):
+        boxes, confs, classes = [], [], []
+        sheet = zip(ANSWER_REGIONS, crops[i * n:(i + 1) * n], outputs[i * n:(i + 1) * n])
+        for (x, y, _, _), (_, scale), (b, c, k) in sheet:
+            # Crop coordinates (at the crop's scale) -> aligned-sheet coordinates
+            boxes.append(b / scale + np.array([x, y, x, y], dtype=b.dtype))
+            confs.append(c)
+            classes.append(k)
+        per_sheet.append((np.concatenate(boxes).reshape(-1, 4), np.concatenate(confs), np.concatenate(classes)))
+    return per_sheet
+
+@timed("reg_number", "model")
+def extract_reg_number_batch(region_imgs, model=None):
+    if model is None:
+        model = get_model(REG_MODEL_PATH)
+    results = model.predict(region_imgs, conf=CONF_THRESHOLD_REG)
+    return [decode_reg_number(r, model.names) for r in results]
+
 # === STEP 3: Divide Questions ===
 def divide_question_box(box, num_questions=15):
     x, y, w, h = box
     row_height = h / num_questions
     return [(x, y + i * row_height, w, row_height) for i in range(num_questions)]
 
+@timed("map_bubbles")
 def map_bubbles_to_questions(boxes, confs, classes, q1_box, q2_box):
     q1_rows = divide_question_box(q1_box, 15)
     q2_rows = divide_question_box(q2_box, 15)
@@ -137,7 +296,7 @@ def map_bubbles_to_questions(boxes, confs, classes, q1_box, q2_box):
     return question_map
 
 # === STEP 4: Grading ===
-def grade_answers(question_map):
+def grade_answers(question_map, sources=None):
     score, results = 0, []
     for q_num, (marked, conf) in question_map.items():
         correct = CORRECT_ANSWERS.get(q_num, "?")
@@ -154,35 +313,99 @@ def grade_answers(question_map):
             "marked": marked if marked else "-",
             "correct": correct,
             "status": status,
-            "confidence": conf
+            "confidence": conf,
+            "source": sources.get(q_num, "model") if sources else "model"
         })
     return {"score": score, "total": len(CORRECT_ANSWERS), "details": results}
 
-# === MAIN PIPELINE ===
-def process_sheet(image_path: str):
+# === MODEL WARM-UP ===
+def warm_up_models():
+    # Load both models and run one inference on a blank sheet so the first
+    # real request doesn't pay for graph construction / lazy initialisation
+    mcq_model = get_model(MCQ_MODEL_PATH)
+    reg_model = get_model(REG_MODEL_PATH)
+
+    dummy = np.full((TEMPLATE_HEIGHT, TEMPLATE_WIDTH, 3), 255, dtype=np.uint8)
+    run_stages(partial(extract_reg_number, crop_zone(dummy, REGION_REG_NO), reg_model),
+               partial(predict_mcq, dummy, mcq_model))
+
+# === IMAGE SOURCES ===
+class ImageDecodeError(ValueError):
+    pass
+
+def load_sheet(image_path: str):
     if not os.path.exists(image_path):
         raise FileNotFoundError("Image not found.")
+    return cv2.imread(image_path)
+
+@timed("decode", "decode")
+def decode_image(data):
+    # Encoded JPEG/PNG bytes straight from the upload buffer, no temp file
+    if len(data) == 0:
+        raise ImageDecodeError("Empty image upload.")
+    try:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except cv2.error:
+        image = None
+    if image is None:
+        raise ImageDecodeError("Could not decode image.")
+    return image
+
+def load_image(source):
+    # An image source is a decoded ndarray, encoded bytes, or a file path
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return decode_image(source)
+    return load_sheet(source)
 
-    original = cv2.imread(image_path)
-
-    # Step 1: Align
-    aligned = find_markers_and_align(original)
+# === MAIN PIPELINE ===
+# `debug` is a debug_artifacts.DebugArtifacts handle, or None to write nothing
+def prepare_sheet(original, debug=None, reader=DEFAULT_READER):
+    # Returns (aligned, reg_zone); `aligned` is AlignedRegions when only the regions are needed
+    if regions_only(reader):
+        regions = align_regions(original)
+        if regions is not None:
+            if debug is not None:
+                for name, region in (("zone_reg", REGION_REG_NO), ("zone_q1_15", REGION_Q1_15), ("zone_q16_30", REGION_Q16_30)):
+                    debug.save(name, regions[region][0])
+            return regions, regions[REGION_REG_NO][0]
+        aligned = original
+    else:
+        # Step 1: Align
+        aligned = find_markers_and_align(original, debug)
 
     # Step 2: Crop zones
     reg_zone = crop_zone(aligned, REGION_REG_NO)
-    cv2.imwrite("debug_outputs/zone_reg.jpg", reg_zone)
-    cv2.imwrite("debug_outputs/zone_q1_15.jpg", crop_zone(aligned, REGION_Q1_15))
-    cv2.imwrite("debug_outputs/zone_q16_30.jpg", crop_zone(aligned, REGION_Q16_30))
-
-    # Step 3: Extract Reg. Number
-    reg_number = extract_reg_number(reg_zone)
-
-    # Step 4: YOLO detections
-    boxes, confs, classes = predict_mcq(aligned)
-
-    # Step 5: Mapping + Grading
-    question_map = map_bubbles_to_questions(boxes, confs, classes, REGION_Q1_15, REGION_Q16_30)
-    grading = grade_answers(question_map)
+    if debug is not None:
+        # Encoded and written on the debug-artifact thread
+        debug.save("zone_reg", reg_zone)
+        debug.save("zone_q1_15", crop_zone(aligned, REGION_Q1_15))
+        debug.save("zone_q16_30", crop_zone(aligned, REGION_Q16_30))
+
+    return aligned, reg_zone
+
+def map_detections(detections):
+    boxes, confs, classes = detections
+    return map_bubbles_to_questions(boxes, confs, classes, REGION_Q1_15, REGION_Q16_30)
+
+def read_answers(aligned, reader=DEFAULT_READER, mcq_model=None):
+    # Returns (question_map, sources) where sources[q] records which reader decided question q
+    if reader == "fill":
+        question_map = read_bubbles(aligned)
+        return question_map, dict.fromkeys(question_map, "fill")
+    if reader == "yolo":
+        question_map = map_detections(predict_mcq(aligned, mcq_model))
+        return question_map, dict.fromkeys(question_map, "model")
+    if reader == "cascade":
+        if mcq_model is None:
+            mcq_model = get_model(MCQ_MODEL_PATH)
+        return read_cascade(aligned, mcq_model, CONF_THRESHOLD_MCQ, CLASS_NAMES)
+    raise ValueError(f"Unknown bubble reader '{reader}', expected one of {BUBBLE_READERS}")
+
+@timed("grade")
+def build_results(reg_number, question_map, sources=None):
+    grading = grade_answers(question_map, sources)
     answers = [item["marked"] for item in grading["details"]]
 
     return {
@@ -193,9 +416,26 @@ def process_sheet(image_path: str):
         "answers": answers
     }
 
+def process_sheet(image_path: str, mcq_model=None, reg_model=None, reader=DEFAULT_READER, debug=None):
+    return process_image(load_sheet(image_path), mcq_model, reg_model, reader, debug)
+
+def process_image(source, mcq_model=None, reg_model=None, reader=DEFAULT_READER, debug=None):
+    # Step 1-2: Align + crop zones
+    aligned, reg_zone = prepare_sheet(load_image(source), debug, reader)
+
+    # Step 3-4: Reg. Number + marked answers (YOLO or fill-ratio), run concurrently
+    reg_number, (question_map, sources) = run_stages(
+        partial(extract_reg_number, reg_zone, reg_model),
+        partial(read_answers, aligned, reader, mcq_model),
+    )
+
+    # Step 5: Grading
+    return build_results(reg_number, question_map, sources)
+
 # === TEST RUN ===
 if __name__ == "__main__":
     SAMPLE_IMAGE = "Test_images/sample.jpg"
-    results = process_sheet(SAMPLE_IMAGE)
+    results = process_sheet(SAMPLE_IMAGE, debug=debug_artifacts.DebugArtifacts("sample"))
+    debug_artifacts.shutdown()
 
     print(json.dumps(results, indent=2))
@@ -0,0 +1,192 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+from alignment_quality import AlignmentRejected
+from process_mcq_sheet import (
+    MCQ_MODEL_PATH, REG_MODEL_PATH, REGION_REG_NO, REGION_Q1_15, REGION_Q16_30, ANSWER_REGIONS,
+    CONF_THRESHOLD_MCQ, CONF_THRESHOLD_REG, MCQ_INFERENCE_MODE,
+    prepare_sheet, crop_zone, region_crop, predict_mcq_batch, map_bubbles_to_questions, decode_reg_number,
+)
+from tiling import make_tiles
+from inference_engines import load_engine, load_metadata, to_blob, onnx_path, int8_onnx_path
+
+# === CONFIGURATION ===
+CALIBRATION_DIRS = ["Test_images", "reg_Number"]
+REFERENCE_ENGINE = "torch"      # the FP32 .pt weights are the accuracy baseline
+
+# Accuracy gate: fraction of (sheet, question) decisions / reg-number strings that may
+# differ between FP32 and INT8 before the export is rejected.
+MAX_QUESTION_DISAGREEMENT = 0.01
+MAX_REG_DISAGREEMENT = 0.05
+
+
+# === CORPUS ===
+def list_images(dirs):
+    paths = []
+    for d in dirs:
+        for ext in ("jpg", "jpeg", "png"):
+            paths += glob.glob(os.path.join(d, "**", f"*.{ext}"), recursive=True)
+    return sorted(paths)
+
+def load_corpus(dirs):
+    # Sheets prepared the way the yolo pipeline prepares them under the configured modes (whole
+    # aligned sheets, or AlignedRegions in roi mode) and the reg-number crop each one yields
+    sheets, reg_zones = [], []
+    for path in list_images(dirs):
+        image = cv2.imread(path)
+        if image is None:
+            print(f"⚠️ Skipping unreadable image: {path}")
+            continue
+        try:
+            aligned, reg_zone = prepare_sheet(image, reader="yolo")
+        except AlignmentRejected:
+            # Marker-less images (e.g. reg-number crops) are still useful activation samples
+            aligned, reg_zone = image, crop_zone(image, REGION_REG_NO)
+        sheets.append(aligned)
+        reg_zones.append(reg_zone)
+    return sheets, reg_zones
+
+def _columns(sheet):
+    return [region_crop(sheet, region)[0] for region in ANSWER_REGIONS]
+
+def mcq_model_inputs(sheets):
+    # What the bubble detector is actually fed in MCQ_INFERENCE_MODE: answer-column crops,
+    # native-resolution tiles, or whole sheets
+    if MCQ_INFERENCE_MODE == "roi":
+        return [crop for sheet in sheets for crop in _columns(sheet) if crop.size]
+    if MCQ_INFERENCE_MODE == "tiled":
+        return [sheet[y:y + h, x:x + w] for sheet in sheets for x, y, w, h in make_tiles(sheet.shape)]
+    return sheets
+
+
+# === CALIBRATION ===
+class _CalibrationReader:
+    # Feeds letterboxed calibration images to onnxruntime in the graph's fixed batch size
+    def __init__(self, images, input_name, imgsz, batch):
+        self.batches = []
+        for start in range(0, len(images), batch):
+            blob, _ = to_blob(images[start:start + batch], imgsz)
+            if len(blob) < batch:
+                pad = np.zeros((batch - len(blob),) + blob.shape[1:], dtype=blob.dtype)
+                blob = np.concatenate([blob, pad])
+            self.batches.append({input_name: blob})
+        self._iter = iter(self.batches)
+
+    def get_next(self):
+        return next(self._iter, None)
+
+    def rewind(self):
+        self._iter = iter(self.batches)
+
+
+def quantize_model(pt_path, images):
+    import onnx
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType, CalibrationMethod
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    src = onnx_path(pt_path)
+    if not os.path.exists(src):
+        raise FileNotFoundError(f"{src} not found (run export_models.py --formats onnx first)")
+
+    meta = load_metadata(pt_path)
+    input_name = onnx.load(src, load_external_data=False).graph.input[0].name
+    reader = _CalibrationReader(images, input_name, tuple(meta["imgsz"]), int(meta.get("batch", 1)))
+
+    prepared = os.path.splitext(src)[0] + ".prep.onnx"
+    quant_pre_process(src, prepared)
+    try:
+        quantize_static(
+            prepared, int8_onnx_path(pt_path), reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+    finally:
+        os.remove(prepared)
+    print(f"✅ {pt_path} -> {int8_onnx_path(pt_path)} ({len(images)} calibration images)")
+
+
+# === ACCURACY GATE ===
+def _timed(predict, *args, **kwargs):
+    start = time.perf_counter()
+    outputs = predict(*args, **kwargs)
+    return outputs, time.perf_counter() - start
+
+def compare_mcq(sheets, reference_engine):
+    # Through the pipeline's own bubble path, so roi crops and tiles are what gets compared
+    if MCQ_INFERENCE_MODE == "roi":
+        # Images too small to hold the answer columns (e.g. reg-number crops) have nothing to compare
+        sheets = [sheet for sheet in sheets if all(crop.size for crop in _columns(sheet))]
+    fp32 = load_engine(MCQ_MODEL_PATH, reference_engine)
+    int8 = load_engine(MCQ_MODEL_PATH, "onnxruntime-int8")
+    ref_out, ref_time = _timed(predict_mcq_batch, sheets, fp32)
+    q_out, q_time = _timed(predict_mcq_batch, sheets, int8)
+
+    diffs, total = 0, 0
+    for ref, quant in zip(ref_out, q_out):
+        ref_map = map_bubbles_to_questions(*ref, REGION_Q1_15, REGION_Q16_30)
+        q_map = map_bubbles_to_questions(*quant, REGION_Q1_15, REGION_Q16_30)
+        diffs += sum(ref_map[q][0] != q_map[q][0] for q in ref_map)
+        total += len(ref_map)
+    return diffs / max(total, 1), ref_time, q_time
+
+def compare_reg(reg_zones, reference_engine):
+    fp32 = load_engine(REG_MODEL_PATH, reference_engine)
+    int8 = load_engine(REG_MODEL_PATH, "onnxruntime-int8")
+    ref_out, ref_time = _timed(fp32.predict, reg_zones, conf=CONF_THRESHOLD_REG)
+    q_out, q_time = _timed(int8.predict, reg_zones, conf=CONF_THRESHOLD_REG)
+
+    diffs = sum(decode_reg_number(ref, fp32.names) != decode_reg_number(quant, int8.names)
+                for ref, quant in zip(ref_out, q_out))
+    return diffs / max(len(reg_zones), 1), ref_time, q_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-training static INT8 quantization with an accuracy gate.")
+    parser.add_argument("--calibration", nargs="+", default=CALIBRATION_DIRS)
+    parser.add_argument("--reference", nargs="+", default=CALIBRATION_DIRS,
+                        help="Sheets used to compare FP32 and INT8 decisions")
+    parser.add_argument("--reference-engine", default=REFERENCE_ENGINE)
+    parser.add_argument("--max-question-diff", type=float, default=MAX_QUESTION_DISAGREEMENT)
+    parser.add_argument("--max-reg-diff", type=float, default=MAX_REG_DISAGREEMENT)
+    args = parser.parse_args()
+
+    sheets, reg_zones = load_corpus(args.calibration)
+    if not sheets:
+        sys.exit("❌ No calibration images found")
+    quantize_model(MCQ_MODEL_PATH, mcq_model_inputs(sheets))
+    quantize_model(REG_MODEL_PATH, reg_zones)
+
+    ref_sheets, ref_zones = load_corpus(args.reference)
+    q_diff, q_ref_time, q_int8_time = compare_mcq(ref_sheets, args.reference_engine)
+    r_diff, r_ref_time, r_int8_time = compare_reg(ref_zones, args.reference_engine)
+
+    print(f"📊 Bubble model: {q_diff:.2%} question decisions differ "
+          f"({q_ref_time:.2f}s FP32 vs {q_int8_time:.2f}s INT8)")
+    print(f"📊 Reg model:    {r_diff:.2%} reg numbers differ "
+          f"({r_ref_time:.2f}s FP32 vs {r_int8_time:.2f}s INT8)")
+
+    failed = []
+    if q_diff > args.max_question_diff:
+        failed.append((MCQ_MODEL_PATH, f"question disagreement {q_diff:.2%} > {args.max_question_diff:.2%}"))
+    if r_diff > args.max_reg_diff:
+        failed.append((REG_MODEL_PATH, f"reg-number disagreement {r_diff:.2%} > {args.max_reg_diff:.2%}"))
+
+    if failed:
+        # Never leave a rejected INT8 graph where the onnxruntime-int8 engine would pick it up
+        for pt_path, reason in failed:
+            os.remove(int8_onnx_path(pt_path))
+            print(f"❌ Rejected {int8_onnx_path(pt_path)}: {reason}")
+        sys.exit(1)
+    print("✅ INT8 models passed the accuracy gate")
+
+
+if __name__ == "__main__":
+    main()
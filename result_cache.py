@@ -0,0 +1,178 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from process_mcq_sheet import (
+    MCQ_MODEL_PATH, REG_MODEL_PATH, CORRECT_ANSWERS, CLASS_NAMES,
+    CONF_THRESHOLD_MCQ, CONF_THRESHOLD_REG, MCQ_INFERENCE_MODE, ROI_IMGSZ, REG_IMGSZ, WARP_MODE,
+)
+from inference_engines import INFERENCE_ENGINE
+from fill_reader import FILL_THRESHOLD, SAMPLE_HALF
+from cascade_reader import CASCADE_BLANK_MAX, CASCADE_MARGIN, CASCADE_IMGSZ
+from tiling import TILE_SIZE, TILE_OVERLAP
+from fiducials import FIDUCIAL_MODE
+from marker_search import MARKER_SEARCH
+from alignment_quality import ALIGN_CHECK
+import homography_cache
+
+# === CONFIGURATION ===
+# Results of already-graded uploads, keyed by SHA-256 of the image bytes + reader + pipeline version
+CACHE_ENTRIES = int(os.environ.get("MCQ_CACHE_ENTRIES", "512"))
+# Optional on-disk tier; empty disables it
+CACHE_DIR = os.environ.get("MCQ_CACHE_DIR", "")
+CACHE_DISK_MB = float(os.environ.get("MCQ_CACHE_DISK_MB", "256"))
+# Bump to invalidate every cached result by hand
+CACHE_SALT = os.environ.get("MCQ_CACHE_VERSION", "1")
+
+
+def _model_stamp(path):
+    # Retraining a model replaces the file, which changes size and mtime
+    try:
+        st = os.stat(path)
+        return [path, st.st_size, int(st.st_mtime)]
+    except OSError:
+        return [path, None, None]
+
+def pipeline_version():
+    # Everything that changes a result for the same image bytes
+    config = {
+        "salt": CACHE_SALT,
+        "answers": sorted(CORRECT_ANSWERS.items()),
+        "classes": CLASS_NAMES,
+        "models": [_model_stamp(MCQ_MODEL_PATH), _model_stamp(REG_MODEL_PATH)],
+        "engine": INFERENCE_ENGINE,
+        "mode": [MCQ_INFERENCE_MODE, list(ROI_IMGSZ), list(REG_IMGSZ), list(CASCADE_IMGSZ),
+                 TILE_SIZE, TILE_OVERLAP, WARP_MODE],
+        # A sheet graded with the check off must not be served once it is on (it would be a 422)
+        "alignment": [FIDUCIAL_MODE, MARKER_SEARCH, ALIGN_CHECK,
+                      homography_cache.ALIGN_CACHE, homography_cache.MAX_DRIFT_PX],
+        "thresholds": [CONF_THRESHOLD_MCQ, CONF_THRESHOLD_REG, FILL_THRESHOLD, SAMPLE_HALF,
+                       CASCADE_BLANK_MAX, CASCADE_MARGIN],
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def cache_key(image_bytes, reader, version):
+    return f"{hashlib.sha256(image_bytes).hexdigest()}-{reader}-{version}"
+
+
+# === TWO-TIER CACHE ===
+# Memory tier: LRU of result dicts (treated as read-only by callers).
+# Disk tier: one JSON file per key, least recently used files evicted past the size budget.
+class ResultCache:
+    def __init__(self, entries=CACHE_ENTRIES, cache_dir=CACHE_DIR, disk_mb=CACHE_DISK_MB):
+        self.entries = max(0, entries)
+        self.cache_dir = cache_dir or None
+        self.disk_budget = int(disk_mb * 1024 * 1024)
+        self.version = pipeline_version()
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def key(self, image_bytes, reader):
+        return cache_key(image_bytes, reader, self.version)
+
+    def get_memory(self, key):
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+            elif not self.cache_dir:
+                self._stats["misses"] += 1
+            return result
+
+    def get_disk(self, key):
+        # Only called after a memory miss; promotes hits to the memory tier
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                result = json.load(f)
+            os.utime(path)          # mtime doubles as the disk tier's LRU clock
+        except (OSError, ValueError):
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            self._stats["disk_hits"] += 1
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.cache_dir:
+            self._write_disk(key, result)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["memory_hit_ratio"] = stats["memory_hits"] / lookups if lookups else 0.0
+        stats["disk_hit_ratio"] = stats["disk_hits"] / lookups if lookups else 0.0
+        stats["disk_bytes"] = self._disk_bytes if self.cache_dir else None
+        stats["version"] = self.version
+        return stats
+
+    def _remember(self, key, result):
+        if not self.entries:
+            return
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.entries:
+                self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _disk_files(self):
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+        return files
+
+    def _write_disk(self, key, result):
+        data = json.dumps(result).encode()
+        if len(data) > self.disk_budget:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with self._disk_lock:
+            try:
+                old = os.path.getsize(path) if os.path.exists(path) else 0
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self._disk_bytes += len(data) - old
+                if self._disk_bytes > self.disk_budget:
+                    self._evict_disk()
+            except OSError as e:
+                print("⚠️ Result cache write failed:", str(e))
+
+    def _evict_disk(self):
+        # Oldest first down to 90% of the budget, so eviction doesn't run on every write
+        files = sorted(self._disk_files())
+        total = sum(size for _, _, size in files)
+        target = int(self.disk_budget * 0.9)
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
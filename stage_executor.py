@@ -0,0 +1,57 @@
+import os
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# === CONFIGURATION ===
+# Reg-number extraction and bubble detection don't depend on each other, so they run side by
+# side, each on its own single-thread pool with its share of the CPU cores. Keeping each model
+# on one thread also means a model instance is never used by two threads at once. The pools are
+# process-wide: with MCQ_GRADING_THREADS > 1 the grading threads still queue for the same two
+# model threads, so extra grading threads overlap decode and alignment with inference but never
+# run two inferences of one model in parallel (use MCQ_WORKERS for that).
+CONCURRENT_STAGES = os.environ.get("MCQ_CONCURRENT_STAGES", "1") == "1"
+_CPU_COUNT = os.cpu_count() or 1
+MCQ_STAGE_THREADS = int(os.environ.get("MCQ_STAGE_THREADS", max(1, _CPU_COUNT * 2 // 3)))
+REG_STAGE_THREADS = int(os.environ.get("REG_STAGE_THREADS", max(1, _CPU_COUNT - MCQ_STAGE_THREADS)))
+
+# OpenCV's thread pool is process-wide, so it gets the combined budget
+cv2.setNumThreads(MCQ_STAGE_THREADS + REG_STAGE_THREADS)
+
+
+def _limit_threads(threads):
+    # Under OpenMP builds torch's intra-op thread count is per calling thread
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+if CONCURRENT_STAGES:
+    _reg_pool = ThreadPoolExecutor(1, "reg-stage", initializer=_limit_threads, initargs=(REG_STAGE_THREADS,))
+    _mcq_pool = ThreadPoolExecutor(1, "mcq-stage", initializer=_limit_threads, initargs=(MCQ_STAGE_THREADS,))
+    _pools = (_reg_pool, _mcq_pool)
+else:
+    # MCQ_CONCURRENT_STAGES=0: both stages, one after the other, on a single stage thread with the
+    # whole budget; the models still never run on the grading threads themselves
+    _serial_pool = ThreadPoolExecutor(1, "model-stages", initializer=_limit_threads,
+                                      initargs=(MCQ_STAGE_THREADS + REG_STAGE_THREADS,))
+    _pools = (_serial_pool,)
+
+
+# === STAGE EXECUTOR ===
+def _run_serially(reg_fn, mcq_fn):
+    return reg_fn(), mcq_fn()
+
+def run_stages(reg_fn, mcq_fn):
+    # Returns (reg_fn(), mcq_fn()) once both have finished
+    if not CONCURRENT_STAGES:
+        return _serial_pool.submit(_run_serially, reg_fn, mcq_fn).result()
+    reg_future = _reg_pool.submit(reg_fn)
+    mcq_future = _mcq_pool.submit(mcq_fn)
+    return reg_future.result(), mcq_future.result()
+
+
+def shutdown():
+    for pool in _pools:
+        pool.shutdown(wait=True)
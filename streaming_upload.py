@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import binascii
+
+# === CONFIGURATION ===
+# Largest decoded image accepted by the upload endpoints
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MCQ_MAX_UPLOAD_MB", "16")) * 1024 * 1024)
+
+_CONTENT_KEY = re.compile(rb'"content"\s*:\s*"')
+_DATA_URL_MARKER = b";base64,"
+_MAX_PREFIX = 128      # a data-URL prefix ("data:image/jpeg;base64,") fits in this
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+# === BASE64 -> PREALLOCATED BUFFER ===
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+_NON_B64 = bytes(c for c in range(256) if c not in _B64_ALPHABET)
+
+
+class Base64StreamDecoder:
+    # Decodes base64 text fed in arbitrary chunks into one preallocated byte buffer.
+    # Leftover characters that don't make a full 4-char quantum are carried to the next chunk.
+    def __init__(self, capacity, max_bytes=MAX_UPLOAD_BYTES):
+        self.max_bytes = max_bytes
+        self._buffer = bytearray(min(capacity, max_bytes))
+        self._size = 0
+        self._carry = b""
+
+    def feed(self, text):
+        text = self._carry + text.translate(None, _NON_B64)
+        usable = len(text) - len(text) % 4
+        self._carry = text[usable:]
+        if usable:
+            self._write(binascii.a2b_base64(text[:usable]))
+
+    def _write(self, decoded):
+        end = self._size + len(decoded)
+        if end > self.max_bytes:
+            raise PayloadTooLarge(f"Image exceeds {self.max_bytes // (1024 * 1024)} MB limit.")
+        if end > len(self._buffer):
+            # No usable Content-Length; grow geometrically
+            self._buffer.extend(bytes(max(end - len(self._buffer), len(self._buffer))))
+        self._buffer[self._size:end] = decoded
+        self._size = end
+
+    def finish(self):
+        if self._carry.strip(b"="):
+            # Unpadded tail: pad it so a2b_base64 accepts it
+            self._write(binascii.a2b_base64(self._carry + b"=" * (-len(self._carry) % 4)))
+        self._carry = b""
+        return memoryview(self._buffer)[:self._size]
+
+
+def _unescape(segment):
+    # JSON escapes that can appear in a base64 string: "\/" and line breaks
+    if b"\\" not in segment:
+        return segment
+    return segment.replace(b"\\n", b"").replace(b"\\r", b"").replace(b"\\t", b"").replace(b"\\/", b"/")
+
+
+# === STREAMING JSON INGESTION ===
+async def read_base64_json(chunks, content_length=None, max_bytes=MAX_UPLOAD_BYTES):
+    # Reads a {"filename": ..., "content": "<base64>", ...} body chunk by chunk. The "content"
+    # string is decoded on the fly and never held as text; the small remaining fields are
+    # parsed as JSON afterwards. Returns (fields, image_bytes_view).
+    limit = f"Image exceeds {max_bytes // (1024 * 1024)} MB limit."
+    max_body = max_bytes * 4 // 3 + 64 * 1024
+    if content_length is not None and content_length > max_body:
+        raise PayloadTooLarge(limit)
+
+    decoder = Base64StreamDecoder((content_length or 1024 * 1024) * 3 // 4 + 3, max_bytes)
+    rest = bytearray()          # the JSON body minus the content value
+    state = "before"            # before -> prefix -> content -> after
+    head = b""                  # start of the content string, until any data-URL prefix is known
+    pending = b""               # a trailing backslash whose escape continues in the next chunk
+    received = 0
+
+    async for chunk in chunks:
+        received += len(chunk)
+        if received > max_body:
+            raise PayloadTooLarge(limit)
+
+        if state == "after":
+            rest += chunk
+            continue
+
+        if state == "before":
+            search_from = max(0, len(rest) - 32)
+            rest += chunk
+            match = _CONTENT_KEY.search(rest, search_from)
+            if match is None:
+                continue
+            chunk = bytes(rest[match.end():])
+            del rest[match.end():]
+            state = "prefix"
+
+        # Inside the content string; base64 never contains a quote, so the first one ends it
+        data = pending + chunk
+        pending = b""
+        end = data.find(b'"')
+        segment = data if end < 0 else data[:end]
+        if end < 0:
+            trailing = len(segment) - len(segment.rstrip(b"\\"))
+            if trailing % 2:
+                segment, pending = segment[:-1], b"\\"
+        segment = _unescape(segment)
+
+        if state == "prefix":
+            # Strip an optional "data:image/...;base64," prefix before decoding
+            head += segment
+            if head.startswith(b"data:"):
+                marker = head.find(_DATA_URL_MARKER)
+                if marker < 0:
+                    if end < 0 and len(head) < _MAX_PREFIX:
+                        continue
+                    raise InvalidPayload("Malformed data URL in content.")
+                head = head[marker + len(_DATA_URL_MARKER):]
+            elif end < 0 and len(head) < len(b"data:"):
+                continue
+            segment, head = head, b""
+            state = "content"
+
+        decoder.feed(segment)
+        if end >= 0:
+            rest += b'"' + data[end + 1:]
+            state = "after"
+
+    if state != "after":
+        raise InvalidPayload('Request body has no complete "content" field.')
+    try:
+        fields = json.loads(bytes(rest))
+    except ValueError as e:
+        raise InvalidPayload(f"Malformed JSON body: {e}")
+    if not isinstance(fields, dict):
+        raise InvalidPayload("Request body must be a JSON object.")
+    return fields, decoder.finish()
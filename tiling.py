@@ -0,0 +1,82 @@
+import os
+import numpy as np
+
+from inference_engines import batched_nms
+from fill_reader import BUBBLE_RADIUS
+
+# === CONFIGURATION ===
+# Tiles are cut from the aligned sheet at native resolution, so every tile is fed to the
+# model without resizing. OVERLAP must be larger than a bubble so each one lies whole in some tile;
+# the default leaves a margin over the 144 px printed bubble for loosely aligned sheets.
+TILE_SIZE = int(os.environ.get("MCQ_TILE_SIZE", "640"))
+TILE_OVERLAP = int(os.environ.get("MCQ_TILE_OVERLAP", "192"))
+TILE_BATCH = int(os.environ.get("MCQ_TILE_BATCH", "16"))
+TILE_IOU_THRESHOLD = 0.5
+EDGE_MARGIN = 4     # px; boxes this close to an inner tile seam are partial bubbles
+
+if TILE_OVERLAP < 2 * BUBBLE_RADIUS:
+    raise ValueError(f"MCQ_TILE_OVERLAP={TILE_OVERLAP} is smaller than a bubble ({2 * BUBBLE_RADIUS} px); "
+                     "bubbles across a tile seam would be dropped")
+
+
+# === TILE GRID ===
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)     # last tile snaps to the edge
+    return starts
+
+def make_tiles(shape, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    h, w = shape[:2]
+    return [(x, y, min(tile, w), min(tile, h))
+            for y in tile_starts(h, tile, overlap)
+            for x in tile_starts(w, tile, overlap)]
+
+
+# === TILED INFERENCE ===
+def _drop_seam_boxes(boxes, tile, shape):
+    # Keep boxes that don't touch an inner tile border; borders on the sheet edge are fine
+    x, y, w, h = tile
+    img_h, img_w = shape[:2]
+    keep = np.ones(len(boxes), dtype=bool)
+    if x > 0:
+        keep &= boxes[:, 0] > EDGE_MARGIN
+    if y > 0:
+        keep &= boxes[:, 1] > EDGE_MARGIN
+    if x + w < img_w:
+        keep &= boxes[:, 2] < w - EDGE_MARGIN
+    if y + h < img_h:
+        keep &= boxes[:, 3] < h - EDGE_MARGIN
+    return keep
+
+def predict_tiled(images, model, conf, tile=TILE_SIZE, overlap=TILE_OVERLAP, batch=TILE_BATCH):
+    # Tiles of every sheet share the same batches; detections are merged back per sheet
+    crops, owners = [], []
+    for i, image in enumerate(images):
+        for t in make_tiles(image.shape, tile, overlap):
+            x, y, w, h = t
+            crops.append(image[y:y + h, x:x + w])
+            owners.append((i, t))
+
+    outputs = []
+    for start in range(0, len(crops), batch):
+        outputs.extend(model.predict(crops[start:start + batch], conf=conf, imgsz=tile))
+
+    merged = [([], [], []) for _ in images]
+    for (i, t), (boxes, confs, classes) in zip(owners, outputs):
+        keep = _drop_seam_boxes(boxes, t, images[i].shape)
+        x, y = t[0], t[1]
+        merged[i][0].append(boxes[keep] + np.array([x, y, x, y], dtype=boxes.dtype))
+        merged[i][1].append(confs[keep])
+        merged[i][2].append(classes[keep])
+
+    results = []
+    for boxes, confs, classes in merged:
+        boxes = np.concatenate(boxes).reshape(-1, 4)
+        confs = np.concatenate(confs)
+        classes = np.concatenate(classes)
+        keep = batched_nms(boxes, confs, classes, TILE_IOU_THRESHOLD)
+        results.append((boxes[keep], confs[keep], classes[keep]))
+    return results
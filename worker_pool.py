@@ -0,0 +1,262 @@
+import os
+import itertools
+import pickle
+import threading
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import Future, InvalidStateError
+import numpy as np
+
+import metrics
+
+# === CONFIGURATION ===
+# MCQ_WORKERS > 0 moves alignment + inference out of the API process into N grading
+# processes, each with its own warm models. 0 keeps grading in the API process.
+NUM_WORKERS = int(os.environ.get("MCQ_WORKERS", "0"))
+WORKER_AFFINITY = os.environ.get("MCQ_WORKER_AFFINITY", "1") == "1"
+DRAIN_TIMEOUT = float(os.environ.get("MCQ_WORKER_DRAIN_TIMEOUT", "30"))
+MONITOR_INTERVAL = 1.0
+# A worker that keeps dying before it is ready (missing weights, out of memory) is restarted after
+# 1, 2, 4, ... s, up to RESTART_BACKOFF_MAX; after MAX_RESTARTS such crashes in a row its slot is
+# given up and the pool reports not ready
+MAX_RESTARTS = int(os.environ.get("MCQ_WORKER_MAX_RESTARTS", "5"))
+RESTART_BACKOFF_MAX = 60.0
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+# === WORKER PROCESS ===
+def _worker_main(cores, task_queue, result_queue):
+    pid = os.getpid()
+    if cores:
+        os.sched_setaffinity(0, cores)
+        # Split this worker's cores between the two model stages (see stage_executor.py)
+        mcq_threads = max(1, len(cores) * 2 // 3)
+        os.environ["MCQ_STAGE_THREADS"] = str(mcq_threads)
+        os.environ["REG_STAGE_THREADS"] = str(max(1, len(cores) - mcq_threads))
+
+    # Imported here so the thread budget above is in place before the pipeline configures itself
+    from process_mcq_sheet import process_image, warm_up_models, DEFAULT_READER, ImageDecodeError
+    from alignment_quality import AlignmentRejected
+    import debug_artifacts
+    warm_up_models()
+    metrics.forward_to_parent(lambda change: result_queue.put(("gauge", pid, None, change)))
+    result_queue.put(("ready", pid, None, None))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, shm_name, shape, dtype, reader, debug = task
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            continue    # cancelled while queued; the API process already released the image
+        try:
+            # Zero-copy view of the image the API process decoded into shared memory
+            image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            result_queue.put(("done", pid, task_id, process_image(image, reader=reader or DEFAULT_READER, debug=debug)))
+        except Exception as e:
+            if not isinstance(e, (AlignmentRejected, ImageDecodeError)):
+                # Retake / undecodable uploads are answers, not faults; no traceback for those
+                traceback.print_exc()
+            # Drop the traceback: its frames hold views into the shared buffer
+            e = e.with_traceback(None)
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(f"{type(e).__name__}: {e}")
+            result_queue.put(("error", pid, task_id, e))
+        finally:
+            image = None
+            shm.close()
+            observations = metrics.take_pending()
+            if observations:
+                result_queue.put(("metrics", pid, None, observations))
+
+    # Write the debug images this worker still has queued
+    debug_artifacts.shutdown()
+
+
+class _Worker:
+    def __init__(self, process, task_queue, cores):
+        self.process = process
+        self.task_queue = task_queue
+        self.cores = cores
+        self.ready = False
+        self.inflight = set()
+        self.gauges = {}            # (name, labels) -> this worker's share of the API process gauges
+        self.failures = 0           # crashes in a row without reaching ready
+        self.restart_at = None      # monotonic time of the next restart attempt
+        self.given_up = False
+
+
+# === POOL ===
+class GradingWorkerPool:
+    def __init__(self, num_workers=NUM_WORKERS, affinity=WORKER_AFFINITY):
+        self.num_workers = max(1, num_workers)
+        self._ctx = mp.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._workers = []
+        self._tasks = {}        # task_id -> (future, shm, worker)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._accepting = False
+        self._stopping = False
+        self._core_sets = self._partition_cores() if affinity else [None] * self.num_workers
+
+    def _partition_cores(self):
+        if not hasattr(os, "sched_getaffinity"):
+            return [None] * self.num_workers
+        cores = sorted(os.sched_getaffinity(0))
+        return [set(chunk.tolist()) or None for chunk in np.array_split(cores, self.num_workers)]
+
+    def _spawn(self, cores):
+        task_queue = self._ctx.Queue()
+        process = self._ctx.Process(target=_worker_main, args=(cores, task_queue, self._results),
+                                    name="grading-worker", daemon=True)
+        process.start()
+        return _Worker(process, task_queue, cores)
+
+    def start(self):
+        self._workers = [self._spawn(cores) for cores in self._core_sets]
+        self._accepting = True
+        self._listener = threading.Thread(target=self._listen, name="worker-results", daemon=True)
+        self._listener.start()
+        threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+
+    def is_ready(self):
+        return bool(self._workers) and all(w.ready for w in self._workers)
+
+    def failed_workers(self):
+        return sum(w.given_up for w in self._workers)
+
+    def submit(self, image, reader=None, debug=None):
+        if not self._accepting:
+            raise RuntimeError("Worker pool is not accepting work")
+        image = np.ascontiguousarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+
+        future = Future()
+        with self._lock:
+            live = [w for w in self._workers if not w.given_up]
+            if not live:
+                shm.close()
+                shm.unlink()
+                raise WorkerCrashed("Every grading worker failed to start")
+            worker = min(live, key=lambda w: (not w.process.is_alive(), len(w.inflight)))
+            task_id = next(self._ids)
+            worker.inflight.add(task_id)
+            self._tasks[task_id] = (future, shm, worker)
+        # A cancelled request releases its image at once; the worker then skips the task
+        future.add_done_callback(lambda f, task_id=task_id: f.cancelled() and self._finish(task_id))
+        worker.task_queue.put((task_id, shm.name, image.shape, image.dtype.str, reader, debug))
+        return future
+
+    def _finish(self, task_id, result=None, error=None):
+        with self._lock:
+            entry = self._tasks.pop(task_id, None)
+            if entry is None:
+                return
+            future, shm, worker = entry
+            worker.inflight.discard(task_id)
+        shm.close()
+        shm.unlink()
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass    # the request was cancelled (timeout or client disconnect)
+
+    def _listen(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            kind, pid, task_id, payload = message
+            if kind == "ready":
+                for w in self._workers:
+                    if w.process.pid == pid:
+                        w.ready = True
+            elif kind == "done":
+                self._finish(task_id, result=payload)
+            elif kind == "error":
+                self._finish(task_id, error=payload)
+            elif kind == "metrics":
+                metrics.replay(payload)
+            elif kind == "gauge":
+                # Late changes from a worker already found dead were dropped with its share
+                name, labels, amount = payload
+                for w in self._workers:
+                    if w.process.pid == pid and w.process.is_alive():
+                        w.gauges[(name, labels)] = w.gauges.get((name, labels), 0) + amount
+                        metrics.replay([payload])
+
+    def _drop_gauges(self, worker):
+        # A worker that dies mid-stage never sends the matching decrement
+        metrics.replay([(name, labels, -amount) for (name, labels), amount in worker.gauges.items() if amount])
+        worker.gauges.clear()
+
+    def _monitor(self):
+        # Restart crashed workers, backing off while they keep dying before ready; whatever
+        # they were grading fails with WorkerCrashed
+        while not self._stopping:
+            time.sleep(MONITOR_INTERVAL)
+            now = time.monotonic()
+            for i, worker in enumerate(list(self._workers)):
+                if self._stopping or worker.given_up or worker.process.is_alive():
+                    continue
+                self._drop_gauges(worker)
+                with self._lock:
+                    lost = list(worker.inflight)
+                    worker.inflight.clear()
+                for task_id in lost:
+                    self._finish(task_id, error=WorkerCrashed("Grading worker crashed while processing the sheet"))
+
+                if worker.restart_at is None:
+                    worker.failures = 0 if worker.ready else worker.failures + 1
+                    if worker.failures > MAX_RESTARTS:
+                        worker.given_up = True
+                        print(f"❌ Grading worker {worker.process.pid} failed to start {worker.failures} times "
+                              f"in a row (code {worker.process.exitcode}) — giving up, pool not ready")
+                        continue
+                    delay = min(RESTART_BACKOFF_MAX, 2 ** (worker.failures - 1)) if worker.failures else 0
+                    worker.restart_at = now + delay
+                    print(f"⚠️ Grading worker {worker.process.pid} exited "
+                          f"(code {worker.process.exitcode}) — restarting in {delay:.0f}s")
+                if now < worker.restart_at:
+                    continue
+                replacement = self._spawn(worker.cores)
+                replacement.failures = worker.failures
+                with self._lock:
+                    self._workers[i] = replacement
+                    lost = list(worker.inflight)
+                for task_id in lost:
+                    self._finish(task_id, error=WorkerCrashed("Grading worker crashed while processing the sheet"))
+
+    def shutdown(self, timeout=DRAIN_TIMEOUT):
+        # Drain: stop taking work, let in-flight sheets finish, then stop the workers
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while self._tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self._stopping = True
+        for worker in self._workers:
+            worker.task_queue.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+        for task_id in list(self._tasks):
+            self._finish(task_id, error=RuntimeError("Worker pool shut down before the sheet was graded"))
+        self._results.put(None)
+        self._listener.join(timeout=5)